@@ -3,16 +3,22 @@ import getpass
 import click
 
 from sat.util import validate_rfc, sat_download, join, validate_folder, today, \
-    get_home_user, validate_date
+    get_home_user, validate_date, get_jobs, sync_companies
 from sat import util
-from sat.db import create_tables
-from settings import log
+from sat.db import create_tables, connect, get_templates
+from settings import log, SYNC_PROCESSES, XML_STORAGE
+
+
+def without_credentials(ctx):
+    options = ('directorio_fiel', 'empresas', 'trabajos', 'extraer',
+        'renombrar', 'verificar')
+    return any(o in ctx.params for o in options)
 
 
 def read_credencials(ctx, param, value):
     if 'base_datos' in ctx.params:
         return 'h'
-    if 'directorio_fiel' in ctx.params:
+    if without_credentials(ctx):
         return ''
 
     try:
@@ -39,7 +45,7 @@ def read_credencials(ctx, param, value):
 def check_rfc(ctx, param, value):
     if 'base_datos' in ctx.params:
         return ''
-    if 'directorio_fiel' in ctx.params:
+    if without_credentials(ctx):
         return ''
 
     if 'rfc' in ctx.params:
@@ -60,7 +66,7 @@ def check_rfc(ctx, param, value):
 def check_ciec(ctx, param, value):
     if 'base_datos' in ctx.params:
         return ''
-    if 'directorio_fiel' in ctx.params:
+    if without_credentials(ctx):
         return ''
 
     if 'ciec' in ctx.params:
@@ -155,8 +161,26 @@ help_tipo = 'El tipo de descarga: t=todas, e=emitidas, r=recibidas'
 help_tipo_cfdi = 'El tipo de complemento a descargar, las opciones son:\n' \
     '-1 = Todos, 8 = Estandar\n1048576 = Nomina 1.1\n137438953472 = N 1.2'
 help_sd = 'Solo descarga la lista de CFDI existentes en el SAT, sin descargar el XML'
-help_db = 'Verifica la configuración de la base de datos y crea las tablas necesarias'
+help_db = 'Verifica la configuración de la base de datos, crea las tablas ' \
+    'necesarias y agrega los índices faltantes a una base existente'
 help_ss = 'Evita crear los subdirectorios RFC, Año, mes'
+help_i = 'Modo incremental, omite los periodos cerrados que ya se verificaron ' \
+    'y descargaron en ejecuciones anteriores'
+help_e = 'Sincroniza todas las empresas dadas de alta en la base de datos, ' \
+    'en paralelo, con las fechas y tipo indicados'
+help_j = 'Archivo de trabajos, una tarea por línea: RFC FECHA_INICIAL ' \
+    'FECHA_FINAL TIPO. Cada RFC debe estar dado de alta como empresa'
+help_p = 'Máximo de empresas a sincronizar en paralelo con -e o -j'
+help_as = 'Descarga los XML de forma asíncrona en un solo ciclo de eventos, ' \
+    'requiere aiohttp'
+help_ex = 'Extrae a la base de datos encabezado y conceptos de los XML ' \
+    'nuevos o modificados, en paralelo con -p procesos'
+help_rn = 'Renombra en paralelo los XML del directorio con la plantilla ' \
+    'guardada con este nombre'
+help_ve = 'Verifica en el SAT el estado de los CFDI extraídos con -ex, se ' \
+    'pueden filtrar con -re y -rr'
+help_x = 'Dónde guardar los XML: disco, bd (comprimidos en la base de datos, ' \
+    'sin archivos) o ambos'
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -192,10 +216,23 @@ type_cfdi = ['-1', '8', '1048576', '137438953472']
 @click.option('-bd', '--base-datos', is_flag=True, default=False, help=help_db)
 @click.option('-ss', '--sin-subdirectorios', is_flag=True, default=False, help=help_ss)
 @click.option('-df', '--directorio-fiel', default='', callback=dir_fiel)
+@click.option('-as', '--asincrono', is_flag=True, default=False, help=help_as)
+@click.option('-i', '--incremental', is_flag=True, default=False, help=help_i)
+@click.option('-e', '--empresas', is_flag=True, default=False, help=help_e)
+@click.option('-j', '--trabajos', type=click.Path(exists=True, dir_okay=False),
+    help=help_j)
+@click.option('-p', '--procesos', type=click.IntRange(1, 64),
+    default=SYNC_PROCESSES, help=help_p)
+@click.option('-x', '--xml', type=click.Choice(['disco', 'bd', 'ambos']),
+    default=XML_STORAGE, help=help_x)
+@click.option('-ex', '--extraer', is_flag=True, default=False, help=help_ex)
+@click.option('-rn', '--renombrar', help=help_rn)
+@click.option('-ve', '--verificar', is_flag=True, default=False, help=help_ve)
 def main(credenciales, rfc, ciec, folder, uuid, año, mes, dia, intervalo_dias,
     fecha_inicial, fecha_final, tipo, tipo_complemento, rfc_emisor,
     rfc_receptor, sin_descargar, base_datos, sin_subdirectorios,
-    directorio_fiel):
+    directorio_fiel, asincrono, incremental, empresas, trabajos, procesos,
+    xml, extraer, renombrar, verificar):
 
     """Descarga documentos del SAT automáticamente"""
 
@@ -206,6 +243,24 @@ def main(credenciales, rfc, ciec, folder, uuid, año, mes, dia, intervalo_dias,
         create_tables()
         return
 
+    if opt['extraer']:
+        util.extract_xml(opt['folder'], opt['procesos'])
+        return
+
+    if opt['verificar']:
+        util.verify_invoices(opt['rfc_emisor'], opt['rfc_receptor'])
+        return
+
+    if opt['renombrar']:
+        connect()
+        templates = get_templates()
+        if not opt['renombrar'] in templates:
+            msg = 'No existe la plantilla: {}'.format(opt['renombrar'])
+            raise click.ClickException(msg)
+        util.rename_files(
+            opt['folder'], templates[opt['renombrar']], opt['procesos'])
+        return
+
     if opt['dia']:
         opt['day'] = check_date(opt)
     if opt['fecha_inicial'] and opt['fecha_final'] is None:
@@ -214,6 +269,13 @@ def main(credenciales, rfc, ciec, folder, uuid, año, mes, dia, intervalo_dias,
         if opt['fecha_final'] < opt['fecha_inicial']:
             opt['fecha_inicial'], opt['fecha_final'] = opt['fecha_final'], opt['fecha_inicial']
 
+    if opt['empresas'] or opt['trabajos']:
+        jobs = get_jobs(opt, opt['trabajos'])
+        if isinstance(jobs, str):
+            raise click.ClickException(jobs)
+        sync_companies(jobs, opt['procesos'])
+        return
+
     sat_download(**opt)
 
     return
@@ -19,3 +19,6 @@ DB = {
     'PWD': '',
 }
 
+#~ Token del servicio para resolver el captcha automáticamente, vacío para
+#~ capturarlo manualmente
+TOKEN = ''
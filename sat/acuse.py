@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import os
+import re
+import subprocess
+import threading
+from concurrent import futures
+from datetime import datetime
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+from settings import (
+    log,
+    PDF_TO_TEXT,
+    PDF_WORKERS,
+)
+
+
+TEMPLATE_DATE = '%d/%m/%Y %H:%M:%S'
+RE_DATE = re.compile(r'\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}')
+#~ Posición en el texto de pdftotext de la fecha de cancelación y del UUID
+LINE_DATE = 9
+LINE_UUID = 19
+
+#~ PDF ya procesados: ruta -> (mtime, tamaño, fecha de cancelación o None)
+_processed = {}
+_lock = threading.Lock()
+
+
+def is_available():
+    return PdfReader is not None
+
+
+def _lines_pypdf(path):
+    reader = PdfReader(path)
+    text = '\n'.join(page.extract_text() or '' for page in reader.pages)
+    return text.splitlines()
+
+
+def _lines_pdftotext(path):
+    #~ Con "-" pdftotext escribe en la salida estándar, sin archivo .txt
+    cmd = [PDF_TO_TEXT, path, '-']
+    data = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+    return data.decode('utf-8', 'ignore').splitlines()
+
+
+def _parse(lines, uuid):
+    uuid = uuid.upper()
+    if len(lines) > LINE_UUID and lines[LINE_UUID].strip().upper() == uuid:
+        try:
+            return datetime.strptime(lines[LINE_DATE].strip(), TEMPLATE_DATE)
+        except ValueError:
+            return None
+
+    #~ Otros extractores no respetan las líneas de pdftotext, solo se acepta
+    #~ si el acuse es del UUID y tiene una sola fecha
+    text = '\n'.join(lines)
+    if uuid not in text.upper():
+        return None
+    dates = set(RE_DATE.findall(text))
+    if len(dates) != 1:
+        return None
+    return datetime.strptime(dates.pop(), TEMPLATE_DATE)
+
+
+def _extract(path, uuid):
+    if is_available():
+        try:
+            date = _parse(_lines_pypdf(path), uuid)
+            if date is not None:
+                return date
+        except Exception as e:
+            log.debug(str(e))
+
+    try:
+        return _parse(_lines_pdftotext(path), uuid)
+    except (OSError, subprocess.CalledProcessError) as e:
+        msg = 'No se pudo leer el acuse: {}'.format(path)
+        log.error(msg)
+        log.debug(str(e))
+    return None
+
+
+def _get_path(path, uuid):
+    for name in (uuid, uuid.upper(), uuid.lower()):
+        path_pdf = os.path.join(path, '{}.pdf'.format(name))
+        if os.path.exists(path_pdf):
+            return path_pdf
+    return ''
+
+
+def get_mtimes(path):
+    """Fecha de modificación de cada acuse en path, por UUID en mayúsculas"""
+    mtimes = {}
+    if not os.path.isdir(path):
+        return mtimes
+    with os.scandir(path) as it:
+        for entry in it:
+            name, ext = os.path.splitext(entry.name)
+            if ext.lower() == '.pdf' and entry.is_file():
+                mtimes[name.upper()] = entry.stat().st_mtime
+    return mtimes
+
+
+def get_date_cancel(path, uuid):
+    """Fecha de cancelación del acuse {uuid}.pdf en path
+
+    Cada PDF se lee una sola vez por proceso, se vuelve a leer solo si
+    cambia su fecha de modificación o su tamaño.
+    """
+    uuid = str(uuid)
+    path_pdf = _get_path(path, uuid)
+    if not path_pdf:
+        return None
+
+    stat = os.stat(path_pdf)
+    key = (stat.st_mtime, stat.st_size)
+    with _lock:
+        cached = _processed.get(path_pdf)
+    if cached is not None and cached[:2] == key:
+        return cached[2]
+
+    date_cancel = _extract(path_pdf, uuid)
+    with _lock:
+        _processed[path_pdf] = key + (date_cancel,)
+    return date_cancel
+
+
+def get_dates_cancel(path, uuids, workers=PDF_WORKERS):
+    """Fechas de cancelación de varios acuses en paralelo
+
+    Regresa un diccionario uuid -> fecha solo con los acuses que tienen
+    fecha. La lectura con pdftotext ocurre en procesos externos, por eso
+    basta un pool de hilos para usar todos los núcleos.
+    """
+    uuids = list(uuids)
+    if not uuids:
+        return {}
+
+    workers = max(1, min(workers, len(uuids)))
+    with futures.ThreadPoolExecutor(workers) as pool:
+        dates = pool.map(lambda u: get_date_cancel(path, u), uuids)
+        result = {u: d for u, d in zip(uuids, dates) if d is not None}
+    return result
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import asyncio
+import threading
+from http.cookies import Morsel
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+from settings import (
+    log,
+    ASYNC_LIMIT,
+    VERIFY_CERT,
+)
+from .policy import CircuitOpen, HttpPolicy, RETRY_STATUS
+from .stream import CHUNK_SIZE, FileStream, XMLStream
+
+
+#~ Encabezados de la sesión que no deben copiarse a cada petición
+SKIP_HEADERS = ('host', 'content-type', 'content-length')
+
+
+def is_available():
+    return aiohttp is not None
+
+
+class AsyncDownloader(object):
+    """Descarga XML y acuses en un solo ciclo de eventos
+
+    Copia en cada download las cookies de la sesión (requests.Session o
+    dict) ya identificada en el SAT, usa un solo pool de conexiones y limita
+    las descargas simultáneas con un semáforo.
+    """
+
+    def __init__(self, session, limit=ASYNC_LIMIT, policy=None,
+        verify=VERIFY_CERT):
+        self._source = session
+        self._limit = max(1, limit)
+        self._policy = policy or HttpPolicy()
+        self._verify = verify
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, daemon=True)
+            self._thread.start()
+        return
+
+    def _headers(self):
+        headers = getattr(self._source, 'headers', {})
+        return {k: v for k, v in headers.items()
+            if k.lower() not in SKIP_HEADERS}
+
+    def _cookies(self):
+        #~ Copia en el hilo que llama a download, la sesión puede renovarse
+        #~ (otra identificación) entre una descarga y otra
+        cookies = getattr(self._source, 'cookies', self._source)
+        if isinstance(cookies, dict):
+            return [(k, v, '', '/') for k, v in cookies.items()]
+        return [(c.name, c.value, c.domain, c.path) for c in cookies]
+
+    def _update_cookies(self, jar, cookies):
+        for name, value, domain, path in cookies:
+            if not domain:
+                jar.update_cookies({name: value})
+                continue
+            morsel = Morsel()
+            morsel.set(name, value, value)
+            morsel['domain'] = domain
+            morsel['path'] = path or '/'
+            url = URL('https://{}/'.format(domain.lstrip('.')))
+            jar.update_cookies({name: morsel}, url)
+        return
+
+    async def _get_client(self):
+        if self._client is None:
+            ssl = None
+            if not self._verify:
+                ssl = False
+            connector = aiohttp.TCPConnector(limit=self._limit, ssl=ssl)
+            self._client = aiohttp.ClientSession(connector=connector,
+                cookie_jar=aiohttp.CookieJar(unsafe=True))
+            self._semaphore = asyncio.Semaphore(self._limit)
+        return self._client
+
+    async def _run(self, func, *args):
+        #~ Abrir, escribir y renombrar archivos bloquea, se hace en el pool de
+        #~ hilos del ciclo para no detener las demás descargas
+        return await self._loop.run_in_executor(None, func, *args)
+
+    async def _fetch(self, client, url, stream, headers):
+        """Descarga url en stream, regresa el error del último intento o ''"""
+        #~ Reintenta continuando desde el último byte recibido
+        policy = self._policy
+        error = ''
+        for delay in policy.delays():
+            await asyncio.sleep(delay)
+            try:
+                policy.check()
+            except CircuitOpen as e:
+                return str(e)
+
+            seconds = policy.timeout(url)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=seconds, sock_read=seconds)
+            outcome = ''
+            await policy.limiter.acquire_async()
+            try:
+                start = self._loop.time()
+                async with client.get(url, headers={**headers,
+                    **stream.headers()}, timeout=timeout) as response:
+                    if response.status in RETRY_STATUS:
+                        outcome = policy.failure(url)
+                        error = 'El SAT respondió {}'.format(response.status)
+                        response.release()
+                        continue
+                    outcome = policy.success(url, self._loop.time() - start)
+                    accepted = await self._run(
+                        stream.accept, response.status, response.headers)
+                    if not accepted:
+                        error = 'Respuesta no válida del SAT: {}'.format(
+                            response.status)
+                        response.release()
+                        if response.status in (206, 416):
+                            continue
+                        return error
+                    await self._run(stream.__enter__)
+                    try:
+                        async for chunk in response.content.iter_chunked(
+                            CHUNK_SIZE):
+                            await self._run(stream.feed, chunk)
+                    finally:
+                        await self._run(stream.__exit__, None, None, None)
+                if not stream.incomplete:
+                    return ''
+                error = 'Descarga incompleta: {} de {} bytes'.format(
+                    stream.size, stream.total)
+                log.debug(error)
+            except asyncio.TimeoutError:
+                outcome = policy.failure(url, True)
+                error = 'Tiempo de espera agotado'
+                log.debug(error)
+            except (aiohttp.ClientPayloadError,
+                aiohttp.ClientConnectionError) as e:
+                outcome = policy.failure(url)
+                error = 'Error de conexión: {}'.format(e)
+                log.debug(error)
+            finally:
+                policy.limiter.release(outcome)
+        return error
+
+    def _check_xml(self, uuid, xml):
+        if xml.close():
+            return (xml.size, xml.sha256, xml.data)
+        msg = 'XML inválido: {} - {}'.format(uuid, xml.error)
+        log.error(msg)
+        return None
+
+    async def _get_xml(self, client, headers, uuid, values, current, count):
+        async with self._semaphore:
+            result = (None, None, None)
+            if values['url']:
+                msg = 'Descargando UUID: {} - {} de {}'.format(
+                    uuid, current, count)
+                log.info(msg)
+                try:
+                    xml = await self._run(
+                        XMLStream, values['path_xml'], values['keep'])
+                    error = await self._fetch(
+                        client, values['url'], xml, headers)
+                    if error:
+                        msg = 'No se pudo descargar el documento: {} - ' \
+                            '{}'.format(uuid, error)
+                        log.error(msg)
+                        return None
+                    result = await self._run(self._check_xml, uuid, xml)
+                except Exception as e:
+                    log.error(str(e))
+                    return None
+                if result is None:
+                    return None
+
+            acuse = True
+            if values['acuse']:
+                acuse = await self._save_acuse(client, headers, uuid, values)
+        return result + (acuse,)
+
+    async def _save_acuse(self, client, headers, uuid, values):
+        msg = 'Descargando acuse del UUID: {}'.format(uuid)
+        log.info(msg)
+
+        try:
+            pdf = await self._run(FileStream, values['path_pdf'])
+            error = await self._fetch(client, values['acuse'], pdf, headers)
+            if error:
+                msg = 'No se pudo descargar el acuse: {} - {}'.format(
+                    uuid, error)
+                log.error(msg)
+                return False
+            if not await self._run(pdf.close):
+                msg = 'Acuse inválido: {} - {}'.format(uuid, pdf.error)
+                log.error(msg)
+                return False
+        except Exception as e:
+            log.error(str(e))
+            return False
+        return True
+
+    async def _download(self, jobs, cookies, headers):
+        client = await self._get_client()
+        self._update_cookies(client.cookie_jar, cookies)
+        total = len(jobs)
+        tasks = [self._get_xml(client, headers, uuid, values, current, total)
+            for current, (uuid, values) in enumerate(jobs, 1)]
+        results = await asyncio.gather(*tasks)
+        return {uuid: r for (uuid, values), r in zip(jobs, results)
+            if r is not None}
+
+    def download(self, jobs):
+        """Descarga una lista de (uuid, values) y espera a que terminen
+
+        values requiere las llaves: url, path_xml, keep, acuse y path_pdf.
+        Regresa uuid -> (tamaño, sha256, datos, acuse) de los XML
+        descargados y válidos, datos solo si keep es verdadero. El acuse se
+        descarga solo si el XML se descargó, acuse es False si falló. Con
+        url vacía solo se descarga el acuse y los tres primeros son None. Las cookies y encabezados
+        de la sesión se copian en cada llamada.
+        """
+        self._start()
+        coroutine = self._download(jobs, self._cookies(), self._headers())
+        f = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        return f.result()
+
+    async def _close_client(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        return
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            f = asyncio.run_coroutine_threadsafe(
+                self._close_client(), self._loop)
+            f.result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+        return
@@ -11,25 +11,53 @@
 # for more details.
 
 import base64
-import os
-import subprocess
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
+from uuid import UUID
 from peewee import *
+from playhouse.migrate import SchemaMigrator, migrate
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from settings import (
     log,
     DB,
     DEBUG,
-    PDF_TO_TEXT,
+    XML_CODEC,
 )
+from . import acuse
 
 
-TEMPLATE_DATE = '%d/%m/%Y %H:%M:%S'
+#~ SQLite limita las variables por consulta, los bloques de insert_many y de
+#~ IN (...) se mantienen por debajo del límite
+CHUNK_SIZE = 50
+IN_SIZE = 500
+#~ Variables por consulta en insert_many de tablas con muchas columnas
+MAX_VARIABLES = 900
+#~ Origen de los datos extraídos de XML guardados en la base de datos
+SOURCE_DB = 'bd'
+#~ Registros por página al recorrer facturas con iter_invoices
+PAGE_SIZE = 1000
+#~ Índice de texto para buscar por UUID, emisor y receptor
+SEARCH_TABLE = 'invoice_search'
+SEARCH_FIELDS = ('uuid', 'emisor', 'rfc_emisor', 'receptor', 'rfc_receptor')
+_search_index = None
+#~ Segundos que SQLite espera a que otro proceso termine de escribir
+SQLITE_TIMEOUT = 60
+#~ Las bases creadas con versiones anteriores se actualizan al conectarse,
+#~ una vez por proceso
+_migrated = False
 
 
 if DB['TYPE'] == 'sqlite':
     #database = SqliteDatabase(DB['NAME'], threadlocals=True)
-    database = SqliteDatabase(DB['NAME'])
+    #~ Con -e/-j varios procesos escriben a la vez, WAL permite leer mientras
+    #~ otro escribe y timeout es lo que se espera a que libere el bloqueo
+    database = SqliteDatabase(DB['NAME'], timeout=SQLITE_TIMEOUT,
+        pragmas=[('journal_mode', 'wal')])
 elif DB['TYPE'] == 'mysql':
     database = MySQLDatabase(DB['NAME'],
         user=DB['USER'], password=DB['PWD'], host=DB['HOST'], port=DB['PORT'])
@@ -60,6 +88,9 @@ class Search(BaseModel):
     date_end = DateTimeField()
     count = IntegerField(default=0)
     verify = IntegerField(default=1)
+    #~ Documentos con liga de descarga, los demás nunca tendrán
+    #~ date_download. Nulo en búsquedas guardadas antes de agregarla
+    downloads = IntegerField(null=True)
 
     class Meta:
         order_by = ('rfc', 'date_start')
@@ -70,6 +101,7 @@ class Search(BaseModel):
 
 class Invoice(BaseModel):
     uuid = UUIDField(unique=True)
+    #~ sha256 del XML guardado en Document, ver save_xml y get_xml
     xml = TextField(null=True)
     path = CharField(max_length=2000, null=True)
     date_download = DateTimeField(null=True)
@@ -86,9 +118,103 @@ class Invoice(BaseModel):
     total = DecimalField(default=0.0, decimal_places=4, auto_round=True, null=True)
     acuse = BooleanField(default=False)
     pagada = BooleanField(default=False)
+    #~ Revisión del acuse de cancelación: última vez, intentos y fecha de
+    #~ modificación del PDF revisado
+    date_check = DateTimeField(null=True)
+    check_count = IntegerField(default=0, null=True)
+    #~ Doble precisión, FloatField es de precisión simple en Postgres/MySQL
+    acuse_mtime = DoubleField(null=True)
 
     class Meta:
         order_by = ('date_cfdi',)
+        indexes = (
+            (('rfc_emisor', 'date_cfdi', 'date_download'), False),
+            (('rfc_receptor', 'date_cfdi', 'date_download'), False),
+            (('rfc_emisor', 'acuse', 'date_cancel'), False),
+            (('estatus', 'date_cfdi'), False),
+            (('tipo', 'date_cfdi'), False),
+            (('date_cfdi',), False),
+            (('date_download',), False),
+        )
+
+
+INVOICE_FIELDS = (Invoice.id, Invoice.uuid, Invoice.date_cfdi,
+    Invoice.emisor, Invoice.rfc_emisor, Invoice.receptor,
+    Invoice.rfc_receptor, Invoice.tipo, Invoice.estatus,
+    Invoice.date_cancel, Invoice.total)
+
+
+class Document(BaseModel):
+    """XML comprimido, uno por contenido sin importar cuántas facturas lo usen"""
+    sha256 = CharField(max_length=64, unique=True)
+    codec = CharField(max_length=10)
+    size = IntegerField()
+    data = BlobField()
+
+
+def _amount():
+    return DecimalField(
+        max_digits=24, decimal_places=6, auto_round=True, null=True)
+
+
+class InvoiceDetail(BaseModel):
+    """Datos del XML de cada factura, ver sat.extract"""
+    uuid = UUIDField(unique=True)
+    version = CharField(max_length=5, null=True)
+    serie = CharField(max_length=25, null=True)
+    folio = CharField(max_length=40, null=True)
+    fecha = DateTimeField(null=True)
+    tipo = CharField(null=True)
+    subtotal = _amount()
+    descuento = _amount()
+    total = _amount()
+    moneda = CharField(null=True)
+    tipo_cambio = _amount()
+    forma_pago = TextField(null=True)
+    metodo_pago = TextField(null=True)
+    lugar_expedicion = TextField(null=True)
+    rfc_emisor = CharField(max_length=15, null=True)
+    rfc_receptor = CharField(max_length=15, null=True)
+    uso_cfdi = CharField(max_length=10, null=True)
+    traslados = _amount()
+    retenciones = _amount()
+    #~ Archivo (o SOURCE_DB) del que se leyó, solo se vuelve a leer si cambia
+    source = CharField(max_length=2000)
+    sha256 = CharField(max_length=64)
+    #~ Doble precisión, FloatField es de precisión simple en Postgres/MySQL
+    mtime = DoubleField(null=True)
+    size = IntegerField(null=True)
+
+    class Meta:
+        order_by = ('fecha',)
+        indexes = (
+            (('rfc_emisor', 'fecha'), False),
+            (('rfc_receptor', 'fecha'), False),
+        )
+
+
+class InvoiceConcept(BaseModel):
+    detail = ForeignKeyField(InvoiceDetail, related_name='concepts',
+        on_delete='CASCADE')
+    clave = CharField(max_length=20, null=True)
+    no_identificacion = CharField(max_length=100, null=True)
+    cantidad = _amount()
+    clave_unidad = CharField(max_length=10, null=True)
+    unidad = CharField(max_length=50, null=True)
+    descripcion = TextField(null=True)
+    valor_unitario = _amount()
+    importe = _amount()
+    descuento = _amount()
+
+
+class InvoiceStatus(BaseModel):
+    """Último estado consultado en el SAT de cada CFDI, ver sat.status"""
+    uuid = UUIDField(unique=True)
+    estado = CharField(max_length=50)
+    codigo = CharField(max_length=250, null=True)
+    cancelable = CharField(max_length=50, null=True)
+    estatus_cancelacion = CharField(max_length=50, null=True)
+    date_check = DateTimeField(index=True)
 
 
 class Template(BaseModel):
@@ -99,6 +225,10 @@ class Template(BaseModel):
         order_by = ('name',)
 
 
+MODELS = [Company, Search, Invoice, Document, InvoiceDetail, InvoiceConcept,
+    InvoiceStatus, Template]
+
+
 def connect():
     global database
     msg = 'Intentando conectarse a la base de datos'
@@ -107,6 +237,12 @@ def connect():
         database.connect()
     msg = 'Conectado correctamente a la base de datos'
     log.debug(msg)
+    if not _migrated:
+        try:
+            migrate_tables()
+        except DatabaseError as e:
+            msg = 'No se pudo actualizar la base de datos: {}'.format(e)
+            log.error(msg)
     return
 
 
@@ -115,44 +251,209 @@ def create_tables():
     connect()
     msg = 'Creando tablas...'
     log.info(msg)
-    #database.create_tables([Company, Search, Invoice, Template], True)
-    database.create_tables([Company, Search, Invoice, Template])
+    database.create_tables(MODELS, True)
     msg = 'Tablas creadas correctamente...'
     log.info(msg)
+    migrate_tables()
+    return
+
+
+def _migrate_indexes(model):
+    table = model._meta.db_table
+    fields = model._meta.fields
+    existing = {tuple(i.columns) for i in database.get_indexes(table)}
+    for names, unique in model._meta.indexes:
+        columns = tuple(fields[n].db_column for n in names)
+        if columns in existing:
+            continue
+        msg = 'Creando índice {}({})...'.format(table, ', '.join(columns))
+        log.info(msg)
+        database.create_index(model, list(names), unique)
+    return
+
+
+def _has_search_index():
+    global _search_index
+    if _search_index is None:
+        _search_index = False
+        if DB['TYPE'] == 'sqlite':
+            _search_index = SEARCH_TABLE in database.get_tables()
+        elif DB['TYPE'] == 'postgres':
+            _search_index = True
+    return _search_index
+
+
+def _create_search_sqlite():
+    if SEARCH_TABLE in database.get_tables():
+        return
+    msg = 'Creando índice de búsqueda por texto...'
+    log.info(msg)
+    columns = ', '.join(SEARCH_FIELDS)
+    new = ', '.join('new.{}'.format(c) for c in SEARCH_FIELDS)
+    old = ', '.join('old.{}'.format(c) for c in SEARCH_FIELDS)
+    sql = (
+        "CREATE VIRTUAL TABLE {0} USING fts5({1}, content='invoice', "
+        "content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER {0}_ai AFTER INSERT ON invoice BEGIN "
+        "INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2}); END",
+        "CREATE TRIGGER {0}_ad AFTER DELETE ON invoice BEGIN "
+        "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {3}); END",
+        "CREATE TRIGGER {0}_au AFTER UPDATE OF {1} ON invoice BEGIN "
+        "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {3}); "
+        "INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2}); END",
+        "INSERT INTO {0}({0}) VALUES ('rebuild')",
+    )
+    for q in sql:
+        database.execute_sql(q.format(SEARCH_TABLE, columns, new, old))
+    return
+
+
+def _create_search_postgres():
+    names = {i.name for i in database.get_indexes('invoice')}
+    if all('invoice_{}_trgm'.format(c) in names for c in SEARCH_FIELDS):
+        return
+    msg = 'Creando índice de búsqueda por texto...'
+    log.info(msg)
+    database.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for c in SEARCH_FIELDS:
+        column = c
+        if c == 'uuid':
+            column = '(CAST(uuid AS TEXT))'
+        sql = 'CREATE INDEX IF NOT EXISTS invoice_{}_trgm ON invoice ' \
+            'USING gin ({} gin_trgm_ops)'.format(c, column)
+        database.execute_sql(sql)
+    return
+
+
+def _migrate_search():
+    global _search_index
+    try:
+        with database.atomic():
+            if DB['TYPE'] == 'sqlite':
+                _create_search_sqlite()
+            elif DB['TYPE'] == 'postgres':
+                _create_search_postgres()
+    except DatabaseError as e:
+        msg = 'No se pudo crear el índice de búsqueda: {}'.format(e)
+        log.error(msg)
+    _search_index = None
     return
 
 
+def _migrate_columns(model):
+    table = model._meta.db_table
+    existing = {c.name for c in database.get_columns(table)}
+    migrator = SchemaMigrator.from_database(database)
+    operations = []
+    for field in model._meta.sorted_fields:
+        if field.db_column in existing:
+            continue
+        msg = 'Agregando columna {}.{}...'.format(table, field.db_column)
+        log.info(msg)
+        operations.append(migrator.add_column(table, field.db_column, field))
+    if operations:
+        migrate(*operations)
+    return
+
+
+def migrate_tables():
+    """Actualiza una base de datos existente sin volver a crearla
+
+    Crea las tablas y agrega las columnas e índices que falten, se puede
+    ejecutar cuantas veces sea necesario.
+    """
+    global database, _migrated
+    _migrated = True
+    connect()
+    msg = 'Actualizando tablas...'
+    log.debug(msg)
+    with database.atomic():
+        database.create_tables(MODELS, True)
+        for model in MODELS:
+            _migrate_columns(model)
+            _migrate_indexes(model)
+    _migrate_search()
+    msg = 'Tablas actualizadas correctamente...'
+    log.debug(msg)
+    return
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _insert_new(model, rows, key):
+    """Inserta rows, regresa los valores de key de los que ya existían"""
+    duplicates = set()
+    for chunk in _chunks(rows):
+        try:
+            with database.atomic():
+                model.insert_many(chunk).execute()
+        except IntegrityError:
+            #~ Otro hilo (emitidas/recibidas) ya insertó alguno del bloque
+            for row in chunk:
+                try:
+                    with database.atomic():
+                        model.insert(**row).execute()
+                except IntegrityError:
+                    duplicates.add(row[key])
+    return duplicates
+
+
 def previous_download(invoices):
+    pages = {}
+    for uuid, values in invoices:
+        pages[UUID(uuid)] = (uuid, values)
+    keys = list(pages)
+
+    existing = {}
+    fields = (Invoice.uuid, Invoice.date_download, Invoice.estatus,
+        Invoice.date_cancel, Invoice.acuse)
+    for chunk in _chunks(keys, IN_SIZE):
+        rows = Invoice.select(*fields).where(Invoice.uuid.in_(chunk)).tuples()
+        for row in rows:
+            existing[row[0]] = row[1:]
+
     for_download = []
+    new_rows = []
+    changes = {}
+    for key in keys:
+        uuid, values = pages[key]
+        data = values.copy()
+        data['acuse'] = bool(data['acuse'])
+        del data['url']
+
+        if not key in existing:
+            data['uuid'] = uuid
+            new_rows.append(data)
+            if values['url']:
+                for_download.append((uuid, values))
+            continue
+
+        date_download, estatus, date_cancel, acuse = existing[key]
+        if data['date_cancel'] is not None:
+            new_data = (data['date_cancel'], data['estatus'], data['acuse'])
+            if new_data != (date_cancel, estatus, acuse):
+                changes.setdefault(new_data, []).append(key)
+        if date_download is None and values['url']:
+            for_download.append((uuid, values))
+
     with database.atomic():
-        for uuid, values in invoices:
-            data = values.copy()
-            data['acuse'] = bool(data['acuse'])
-            #~ Fix in Windows, ToDo
-            #~ obj, created = Invoice.create_or_get(uuid=uuid)
-            created = True
-            try:
-                obj = Invoice.create(uuid=uuid)
-            except IntegrityError:
-                created = False
-                obj = Invoice.get(uuid=uuid)
-            if created:
-                del data['url']
-                q = Invoice.update(**data).where(Invoice.uuid==uuid)
+        duplicates = _insert_new(Invoice, new_rows, 'uuid')
+        for (date_cancel, estatus, acuse), uuids in changes.items():
+            new_data = {
+                'date_cancel': date_cancel,
+                'estatus': estatus,
+                'acuse': acuse,
+            }
+            for chunk in _chunks(uuids, IN_SIZE):
+                q = Invoice.update(**new_data).where(Invoice.uuid.in_(chunk))
                 q.execute()
-                if values['url']:
-                    for_download.append((uuid, values))
-            else:
-                if data['date_cancel'] is not None:
-                    new_data = {
-                        'date_cancel': data['date_cancel'],
-                        'estatus': data['estatus'],
-                        'acuse': data['acuse'],
-                    }
-                    q = Invoice.update(**new_data).where(Invoice.uuid==uuid)
-                    q.execute()
-                if obj.date_download is None and values['url']:
-                    for_download.append((uuid, values))
+
+    #~ El otro hilo ya los tiene en su lista de descarga
+    if duplicates:
+        for_download = [i for i in for_download if not i[0] in duplicates]
     return for_download
 
 
@@ -163,47 +464,271 @@ def update_date_download(uuids=[], path='', rfc=''):
                 date_download=datetime.now()).where(Invoice.uuid.in_(uuids))
             q.execute()
     if path:
-        query = Invoice.select().where(
+        update_date_cancel(path, rfc)
+    return
+
+
+def update_date_cancel(path, rfc):
+    """Busca la fecha de cancelación en los acuses pendientes del emisor
+
+    Solo se leen los acuses nuevos o cuyo PDF cambió desde la última
+    revisión, en cada registro se guarda la fecha de la revisión, los
+    intentos y la fecha de modificación del PDF.
+    """
+    mtimes = acuse.get_mtimes(path)
+    if not mtimes:
+        return
+
+    query = (Invoice
+        .select(Invoice.id, Invoice.uuid, Invoice.acuse_mtime)
+        .where(
             Invoice.rfc_emisor==rfc,
             Invoice.acuse==True,
             Invoice.date_cancel==None)
-        for row in query:
-            date_cancel = get_date_cancel(path, row.uuid)
+        .tuples())
+    rows = {}
+    for id, uuid, acuse_mtime in query:
+        uuid = str(uuid)
+        mtime = mtimes.get(uuid.upper())
+        if mtime is None or mtime == acuse_mtime:
+            continue
+        rows[uuid] = (id, mtime)
+    if not rows:
+        return
+
+    msg = 'Revisando {} acuses de cancelación...'.format(len(rows))
+    log.info(msg)
+    dates = acuse.get_dates_cancel(path, rows)
+    now = datetime.now()
+    with database.atomic():
+        for uuid, (id, mtime) in rows.items():
+            date_cancel = dates.get(uuid)
             if date_cancel is not None:
-                print ('Date cancel', date_cancel)
-                row.date_cancel = date_cancel
-                row.save()
+                msg = 'Fecha de cancelación: {} - {}'.format(uuid, date_cancel)
+                log.debug(msg)
+            q = Invoice.update(
+                date_cancel=date_cancel,
+                date_check=now,
+                check_count=fn.COALESCE(Invoice.check_count, 0) + 1,
+                acuse_mtime=mtime).where(Invoice.id==id)
+            q.execute()
     return
 
 
 def get_date_cancel(path, uuid):
-    date_cancel = None
-    name = '{}.pdf'.format(uuid)
-    path_pdf = os.path.join(path, name)
-    if not os.path.exists(path_pdf):
+    return acuse.get_date_cancel(path, uuid)
+
+
+def _compress(data):
+    if XML_CODEC == 'zstd' and zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 9)
+
+
+def _decompress(codec, data):
+    data = bytes(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            msg = 'Instala zstandard para leer los XML guardados con zstd'
+            raise RuntimeError(msg)
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def save_xml(documents):
+    """Guarda en la base de datos los XML de una lista de (uuid, sha256, datos)
+
+    Cada contenido se comprime y se guarda una sola vez, la factura solo
+    guarda el sha256 en Invoice.xml.
+    """
+    if not documents:
+        return
+
+    contents = {sha256: data for uuid, sha256, data in documents}
+    existing = set()
+    for chunk in _chunks(list(contents), IN_SIZE):
+        rows = Document.select(Document.sha256).where(
+            Document.sha256.in_(chunk)).tuples()
+        existing.update(row[0] for row in rows)
+
+    new_rows = []
+    for sha256, data in contents.items():
+        if sha256 in existing:
+            continue
+        codec, compressed = _compress(data)
+        new_rows.append({
+            'sha256': sha256,
+            'codec': codec,
+            'size': len(data),
+            'data': compressed,
+        })
+
+    with database.atomic():
+        #~ El mismo CFDI puede llegar a la vez en emitidas y recibidas
+        _insert_new(Document, new_rows, 'sha256')
+        for uuid, sha256, data in documents:
+            q = Invoice.update(xml=sha256).where(Invoice.uuid==uuid)
+            q.execute()
+    return
+
+
+def get_xml(uuid):
+    """Contenido del XML guardado en la base de datos, bytes o None"""
+    query = (Document
+        .select(Document.codec, Document.data)
+        .join(Invoice, on=(Invoice.xml==Document.sha256))
+        .where(Invoice.uuid==uuid)
+        .tuples())
+    for codec, data in query:
+        return _decompress(codec, data)
+    return None
+
+
+def get_detail_sources():
+    """Archivos ya extraídos: ruta -> (mtime, tamaño)"""
+    query = (InvoiceDetail
+        .select(InvoiceDetail.source, InvoiceDetail.mtime, InvoiceDetail.size)
+        .where(InvoiceDetail.source!=SOURCE_DB)
+        .tuples())
+    return {source: (mtime, size) for source, mtime, size in query}
+
+
+def get_pending_documents():
+    """sha256 de los XML de la base de datos sin extraer o que cambiaron"""
+    query = (Invoice
+        .select(Invoice.xml)
+        .join(InvoiceDetail, JOIN.LEFT_OUTER,
+            on=(InvoiceDetail.uuid==Invoice.uuid))
+        .where(
+            Invoice.xml!=None,
+            (InvoiceDetail.sha256>>None) | (InvoiceDetail.sha256!=Invoice.xml))
+        .distinct()
+        .tuples())
+    return [row[0] for row in query]
+
+
+def iter_documents(hashes):
+    """(sha256, datos) de los XML guardados en la base de datos"""
+    fields = (Document.sha256, Document.codec, Document.data)
+    for chunk in _chunks(hashes):
+        rows = Document.select(*fields).where(
+            Document.sha256.in_(chunk)).tuples()
+        for sha256, codec, data in rows:
+            yield sha256, _decompress(codec, data)
+
+
+def _insert_rows(model, rows):
+    if not rows:
         return
+    size = max(1, MAX_VARIABLES // len(rows[0]))
+    for chunk in _chunks(rows, size):
+        model.insert_many(chunk).execute()
+    return
+
+
+def save_details(rows):
+    """Guarda encabezados y conceptos de una lista de (encabezado, conceptos)
+
+    Los datos anteriores de cada UUID se reemplazan.
+    """
+    data = {UUID(header['uuid']): (header, concepts)
+        for header, concepts in rows}
+    keys = list(data)
+    if not keys:
+        return
+
+    with database.atomic():
+        for chunk in _chunks(keys, IN_SIZE):
+            ids = InvoiceDetail.select(InvoiceDetail.id).where(
+                InvoiceDetail.uuid.in_(chunk))
+            InvoiceConcept.delete().where(
+                InvoiceConcept.detail.in_(ids)).execute()
+            InvoiceDetail.delete().where(
+                InvoiceDetail.uuid.in_(chunk)).execute()
+
+        _insert_rows(InvoiceDetail, [h for h, c in data.values()])
+
+        new_rows = []
+        for chunk in _chunks(keys, IN_SIZE):
+            query = InvoiceDetail.select(
+                InvoiceDetail.id, InvoiceDetail.uuid).where(
+                InvoiceDetail.uuid.in_(chunk)).tuples()
+            for id, uuid in query:
+                for concept in data[uuid][1]:
+                    concept['detail'] = id
+                    new_rows.append(concept)
+        _insert_rows(InvoiceConcept, new_rows)
+    return
+
+
+def get_status_cache(uuids, ttl):
+    """Estados consultados hace menos de ttl segundos: uuid -> resultado"""
+    limit = datetime.now() - timedelta(seconds=ttl)
+    fields = (InvoiceStatus.uuid, InvoiceStatus.estado, InvoiceStatus.codigo,
+        InvoiceStatus.cancelable, InvoiceStatus.estatus_cancelacion)
+    result = {}
+    for chunk in _chunks(list(uuids), IN_SIZE):
+        rows = (InvoiceStatus
+            .select(*fields)
+            .where(InvoiceStatus.uuid.in_(chunk),
+                InvoiceStatus.date_check>=limit)
+            .dicts())
+        for row in rows:
+            result[row.pop('uuid')] = row
+    return result
+
 
-    name = '{}.txt'.format(uuid)
-    path_txt = os.path.join(path, name)
-    cmd = [PDF_TO_TEXT, path_pdf]
-    subprocess.call(cmd)
-    if not os.path.exists(path_txt):
+def save_status(results):
+    """Guarda los estados consultados, uuid -> resultado"""
+    if not results:
         return
 
-    with open(path_txt) as f:
-        data = f.readlines()
-    if data:
-        date = data[9].strip()
-        uuid2 = data[19].strip()
-        if uuid2 == uuid:
-            try:
-                date_cancel = datetime.strptime(date, TEMPLATE_DATE)
-            except:
-                pass
-    return date_cancel
+    now = datetime.now()
+    rows = [{'uuid': uuid,
+        'estado': r['estado'],
+        'codigo': r.get('codigo'),
+        'cancelable': r.get('cancelable'),
+        'estatus_cancelacion': r.get('estatus_cancelacion'),
+        'date_check': now} for uuid, r in results.items()]
+    with database.atomic():
+        for chunk in _chunks(list(results), IN_SIZE):
+            InvoiceStatus.delete().where(
+                InvoiceStatus.uuid.in_(chunk)).execute()
+        _insert_rows(InvoiceStatus, rows)
+    return
+
+
+def iter_status_invoices(emisor='', receptor='', page_size=PAGE_SIZE):
+    """(emisor, receptor, total, uuid) de los CFDI extraídos, ver -ex
+
+    Es un generador paginado por id, peewee no guarda en memoria todos los
+    registros y entre páginas no queda abierta la consulta.
+    """
+    filters = []
+    if emisor:
+        filters.append(InvoiceDetail.rfc_emisor==emisor)
+    if receptor:
+        filters.append(InvoiceDetail.rfc_receptor==receptor)
+    last_id = 0
+    while True:
+        query = (InvoiceDetail
+            .select(InvoiceDetail.id, InvoiceDetail.rfc_emisor,
+                InvoiceDetail.rfc_receptor, InvoiceDetail.total,
+                InvoiceDetail.uuid)
+            .where(InvoiceDetail.id > last_id, *filters)
+            .order_by(InvoiceDetail.id)
+            .limit(page_size)
+            .tuples())
+        rows = list(query)
+        for row in rows:
+            yield row[1:]
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+    return
 
 
-def save_search(rfc, recibidas, date_start, date_end, count):
+def save_search(rfc, recibidas, date_start, date_end, count, downloads=0):
     data = {
         'rfc': rfc,
         'recibidas': recibidas,
@@ -213,63 +738,221 @@ def save_search(rfc, recibidas, date_start, date_end, count):
     obj, created = Search.get_or_create(**data)
     if created:
         obj.count = count
+        obj.downloads = downloads
         obj.save()
     else:
         if count == obj.count:
-            q = Search.update(verify=Search.verify + 1).where(Search.id == obj.id)
+            q = Search.update(verify=Search.verify + 1, downloads=downloads)
+            q = q.where(Search.id == obj.id)
             q.execute()
         elif count > obj.count:
-            q = Search.update(verify=1, count=count).where(Search.id == obj.id)
+            q = Search.update(verify=1, count=count, downloads=downloads)
+            q = q.where(Search.id == obj.id)
             q.execute()
     return
 
 
+def get_coverage(rfc, recibidas, verify, before, limit):
+    """Periodos ya verificados que no es necesario volver a buscar
+
+    Un periodo se considera cubierto si su total se ha confirmado al menos
+    verify veces, terminó antes de before, no llegó al límite de registros
+    del portal y todos sus documentos con liga de descarga ya fueron
+    descargados. Regresa los
+    intervalos (inicio, fin) ordenados y unidos cuando son contiguos.
+    """
+    field = Invoice.rfc_receptor
+    if not recibidas:
+        field = Invoice.rfc_emisor
+    on = (
+        (field == rfc) &
+        (Invoice.date_cfdi >= Search.date_start) &
+        (Invoice.date_cfdi <= Search.date_end) &
+        (Invoice.date_download.is_null(False))
+    )
+    downloaded = fn.COUNT(Invoice.id)
+    rows = (Search
+        .select(Search.date_start, Search.date_end)
+        .join(Invoice, JOIN.LEFT_OUTER, on=on)
+        .where(
+            Search.rfc == rfc,
+            Search.recibidas == recibidas,
+            Search.verify >= verify,
+            Search.count < limit,
+            Search.date_end < before)
+        .group_by(Search.id, Search.date_start, Search.date_end, Search.count,
+            Search.downloads)
+        .having(downloaded >= fn.COALESCE(Search.downloads, Search.count))
+        .order_by(Search.date_start)
+        .tuples())
+
+    one = timedelta(seconds=1)
+    intervals = []
+    for start, end in rows:
+        if intervals and start <= intervals[-1][1] + one:
+            if end > intervals[-1][1]:
+                intervals[-1][1] = end
+            continue
+        intervals.append([start, end])
+    return tuple((start, end) for start, end in intervals)
+
+
 def get_companies():
     rows = Company.select().tuples()
     return tuple(rows)
 
 
-def get_invoices(opt={}):
+def _contains(columns, value):
+    """Filtro por subcadena en una o varias columnas de Invoice
+
+    En SQLite usa la tabla FTS5 con trigramas si existe, en Postgres los
+    índices de pg_trgm se usan solos con ILIKE. Búsquedas de menos de tres
+    letras o sin índice usan LIKE.
+    """
+    if 'uuid' in columns and DB['TYPE'] != 'postgres':
+        #~ Fuera de Postgres el UUID se guarda en hexadecimal sin guiones
+        value = value.replace('-', '').lower()
+
+    if DB['TYPE'] == 'sqlite' and len(value) >= 3 and _has_search_index():
+        match = '{%s} : "%s"' % (' '.join(columns), value.replace('"', '""'))
+        sql = '(SELECT rowid FROM {} WHERE {} MATCH ?)'.format(
+            SEARCH_TABLE, SEARCH_TABLE)
+        return Invoice.id << SQL(sql, match)
+
+    expression = None
+    for c in columns:
+        field = getattr(Invoice, c)
+        if c == 'uuid' and DB['TYPE'] == 'postgres':
+            field = fn.CAST(Clause(field, SQL('AS TEXT')))
+        e = field.contains(value)
+        if expression is None:
+            expression = e
+        else:
+            expression = expression | e
+    return expression
+
+
+def _invoice_filters(opt):
     filters = []
-    if opt:
-        uuid = opt.get('uuid', '')
-        if uuid:
-            filters.append(Invoice.uuid.contains(uuid))
-        emisor = opt.get('emisor', '')
-        if emisor:
-            filters.append(Invoice.emisor.contains(emisor) | Invoice.rfc_emisor.contains(emisor))
-        receptor = opt.get('receptor', '')
-        if receptor:
-            filters.append(Invoice.receptor.contains(receptor) | Invoice.rfc_receptor.contains(receptor))
-        type_doc = opt.get('type_doc', '')
-        if type_doc:
-            filters.append(Invoice.tipo==type_doc)
-        status = opt.get('status', '')
-        if status:
-            filters.append(Invoice.estatus==status)
-        year = opt.get('year', 0)
-        if year:
-            filters.append(database.extract_date('year', Invoice.date_cfdi)==year)
-        month = opt.get('month', 0)
-        if month:
-            filters.append(database.extract_date('month', Invoice.date_cfdi)==month)
-        start = opt.get('start', 0)
-        if start:
-            end = opt['end']
-            filters.append(Invoice.date_cfdi.between(start, end))
-
-        rows = Invoice.select(Invoice.id, Invoice.uuid, Invoice.date_cfdi,
-            Invoice.emisor, Invoice.rfc_emisor, Invoice.receptor,
-            Invoice.rfc_receptor, Invoice.tipo, Invoice.estatus,
-            Invoice.date_cancel, Invoice.total).where(*filters).tuples()
-    else:
-        rows = Invoice.select(Invoice.id, Invoice.uuid, Invoice.date_cfdi,
-            Invoice.emisor, Invoice.rfc_emisor, Invoice.receptor,
-            Invoice.rfc_receptor, Invoice.tipo, Invoice.estatus,
-            Invoice.date_cancel, Invoice.total).tuples()
+    uuid = opt.get('uuid', '')
+    if uuid:
+        filters.append(_contains(('uuid',), uuid))
+    emisor = opt.get('emisor', '')
+    if emisor:
+        filters.append(_contains(('emisor', 'rfc_emisor'), emisor))
+    receptor = opt.get('receptor', '')
+    if receptor:
+        filters.append(_contains(('receptor', 'rfc_receptor'), receptor))
+    type_doc = opt.get('type_doc', '')
+    if type_doc:
+        filters.append(Invoice.tipo==type_doc)
+    status = opt.get('status', '')
+    if status:
+        filters.append(Invoice.estatus==status)
+    year = opt.get('year', 0)
+    if year:
+        filters.append(database.extract_date('year', Invoice.date_cfdi)==year)
+    month = opt.get('month', 0)
+    if month:
+        filters.append(database.extract_date('month', Invoice.date_cfdi)==month)
+    start = opt.get('start', 0)
+    if start:
+        end = opt['end']
+        filters.append(Invoice.date_cfdi.between(start, end))
+    return filters
+
+
+def _select_invoices(filters):
+    rows = Invoice.select(*INVOICE_FIELDS)
+    if filters:
+        rows = rows.where(*filters)
+    return rows
+
+
+def get_invoices(opt={}):
+    rows = _select_invoices(_invoice_filters(opt)).tuples()
     return tuple(rows)
 
 
+def _iter_server_side(query, page_size):
+    #~ Cursor con nombre de psycopg2, el servidor entrega los registros por
+    #~ bloques de page_size sin cargar todo el resultado en memoria
+    sql, params = query.sql()
+    converters = [f.python_value for f in INVOICE_FIELDS]
+    name = 'invoices_{}'.format(id(query))
+    cursor = database.get_conn().cursor(name=name, withhold=True)
+    cursor.itersize = page_size
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield tuple(c(v) for c, v in zip(converters, row))
+    finally:
+        cursor.close()
+    return
+
+
+def _iter_keyset(filters, page_size, limit):
+    #~ Paginación por llave (date_cfdi, id), cada página usa el índice en vez
+    #~ de OFFSET. Los registros sin fecha van primero, paginados por id.
+    count = 0
+    last_date = None
+    last_id = 0
+    null_dates = True
+    while True:
+        size = page_size
+        if limit:
+            size = min(size, limit - count)
+            if size <= 0:
+                return
+
+        if null_dates:
+            where = [Invoice.date_cfdi.is_null(), Invoice.id > last_id]
+            order = (Invoice.id,)
+        elif last_date is None:
+            where = [Invoice.date_cfdi.is_null(False)]
+            order = (Invoice.date_cfdi, Invoice.id)
+        else:
+            where = [(Invoice.date_cfdi > last_date) |
+                ((Invoice.date_cfdi == last_date) & (Invoice.id > last_id))]
+            order = (Invoice.date_cfdi, Invoice.id)
+
+        query = _select_invoices(filters + where).order_by(*order).limit(size)
+        rows = 0
+        for row in query.tuples():
+            yield row
+            rows += 1
+            last_id, last_date = row[0], row[2]
+        count += rows
+
+        if rows < size:
+            if not null_dates:
+                return
+            null_dates = False
+            last_date = None
+            last_id = 0
+    return
+
+
+def iter_invoices(opt={}, page_size=PAGE_SIZE, limit=0):
+    """Mismos registros que get_invoices, ordenados por (date_cfdi, id)
+
+    Es un generador que entrega los registros conforme se leen, usa un
+    cursor del lado del servidor en Postgres y paginación por llave en los
+    demás motores. limit=0 regresa todos los registros.
+    """
+    filters = _invoice_filters(opt)
+    if DB['TYPE'] == 'postgres':
+        query = _select_invoices(filters).order_by(
+            Invoice.date_cfdi, Invoice.id)
+        if limit:
+            query = query.limit(limit)
+        yield from _iter_server_side(query, page_size)
+        return
+
+    yield from _iter_keyset(filters, page_size, limit)
+    return
+
+
 def get_emisores():
     rows = Invoice.select(
         Invoice.rfc_emisor).order_by(Invoice.rfc_emisor).distinct().tuples()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+#~ Este módulo se importa en los procesos del pool, no debe depender de la
+#~ base de datos ni de settings
+
+import datetime
+import hashlib
+import os
+from decimal import Decimal, InvalidOperation
+from uuid import UUID
+from xml.etree import ElementTree as ET
+
+
+PRE = {
+    '2.0': '{http://www.sat.gob.mx/cfd/2}',
+    '2.2': '{http://www.sat.gob.mx/cfd/2}',
+    '3.0': '{http://www.sat.gob.mx/cfd/3}',
+    '3.2': '{http://www.sat.gob.mx/cfd/3}',
+    '3.3': '{http://www.sat.gob.mx/cfd/3}',
+    '4.0': '{http://www.sat.gob.mx/cfd/4}',
+    'TIMBRE': '{http://www.sat.gob.mx/TimbreFiscalDigital}',
+}
+
+#~ Campo: atributos en el XML, versión 3.3/4.0 y anteriores
+HEADER = {
+    'version': ('Version', 'version'),
+    'serie': ('Serie', 'serie'),
+    'folio': ('Folio', 'folio'),
+    'tipo': ('TipoDeComprobante', 'tipoDeComprobante'),
+    'subtotal': ('SubTotal', 'subTotal'),
+    'descuento': ('Descuento', 'descuento'),
+    'total': ('Total', 'total'),
+    'moneda': ('Moneda', 'moneda'),
+    'tipo_cambio': ('TipoCambio', 'TipoCambio'),
+    'forma_pago': ('FormaPago', 'formaDePago'),
+    'metodo_pago': ('MetodoPago', 'metodoDePago'),
+    'lugar_expedicion': ('LugarExpedicion', 'LugarExpedicion'),
+}
+CONCEPT = {
+    'clave': ('ClaveProdServ', 'ClaveProdServ'),
+    'no_identificacion': ('NoIdentificacion', 'noIdentificacion'),
+    'cantidad': ('Cantidad', 'cantidad'),
+    'clave_unidad': ('ClaveUnidad', 'ClaveUnidad'),
+    'unidad': ('Unidad', 'unidad'),
+    'descripcion': ('Descripcion', 'descripcion'),
+    'valor_unitario': ('ValorUnitario', 'valorUnitario'),
+    'importe': ('Importe', 'importe'),
+    'descuento': ('Descuento', 'descuento'),
+}
+DECIMALS = ('subtotal', 'descuento', 'total', 'tipo_cambio', 'traslados',
+    'retenciones', 'cantidad', 'valor_unitario', 'importe')
+
+
+def _values(node, fields):
+    data = {}
+    for name, keys in fields.items():
+        value = node.get(keys[0])
+        if value is None:
+            value = node.get(keys[1])
+        if name in DECIMALS and value is not None:
+            try:
+                value = Decimal(value)
+            except InvalidOperation:
+                value = None
+        data[name] = value
+    return data
+
+
+def parse(data):
+    """Encabezado y conceptos de un CFDI en bytes
+
+    Regresa (encabezado, conceptos) o lanza ValueError si no es un CFDI
+    timbrado.
+    """
+    xml = ET.fromstring(data)
+    version = xml.get('Version') or xml.get('version')
+    pre = PRE.get(version)
+    if pre is None:
+        raise ValueError('Versión de CFDI no soportada: {}'.format(version))
+
+    node = xml.find('{}Complemento/{}TimbreFiscalDigital'.format(
+        pre, PRE['TIMBRE']))
+    if node is None:
+        raise ValueError('CFDI sin timbre fiscal')
+
+    header = _values(xml, HEADER)
+    if not node.get('UUID'):
+        raise ValueError('Timbre fiscal sin UUID')
+    #~ Lanza ValueError si el UUID no es válido
+    header['uuid'] = str(UUID(node.get('UUID')))
+    header['fecha'] = datetime.datetime.fromisoformat(
+        (xml.get('Fecha') or xml.get('fecha'))[:19])
+
+    node = xml.find('{}Emisor'.format(pre))
+    header['rfc_emisor'] = node.get('Rfc') or node.get('rfc')
+    node = xml.find('{}Receptor'.format(pre))
+    header['rfc_receptor'] = node.get('Rfc') or node.get('rfc')
+    header['uso_cfdi'] = node.get('UsoCFDI')
+
+    taxes = {'traslados': ('TotalImpuestosTrasladados',
+        'totalImpuestosTrasladados'), 'retenciones': (
+        'TotalImpuestosRetenidos', 'totalImpuestosRetenidos')}
+    node = xml.find('{}Impuestos'.format(pre))
+    if node is None:
+        header.update({k: None for k in taxes})
+    else:
+        header.update(_values(node, taxes))
+
+    concepts = [_values(n, CONCEPT)
+        for n in xml.iterfind('{0}Conceptos/{0}Concepto'.format(pre))]
+    return header, concepts
+
+
+def parse_file(path):
+    """Para el pool: (path, sha256, mtime, size, encabezado, conceptos, error)"""
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+    except OSError as e:
+        return (path, '', None, None, None, None, str(e))
+
+    try:
+        header, concepts = parse(data)
+        error = ''
+    except Exception as e:
+        header, concepts, error = None, None, str(e)
+    return (path, sha256, stat.st_mtime, stat.st_size, header, concepts, error)
+
+
+def parse_document(document):
+    """Para el pool: (sha256, datos) -> (sha256, encabezado, conceptos, error)"""
+    sha256, data = document
+    try:
+        header, concepts = parse(data)
+        return (sha256, header, concepts, '')
+    except Exception as e:
+        return (sha256, None, None, str(e))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import base64
+import hashlib
+import os
+import re
+import subprocess
+import threading
+from dateutil import parser
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+    x509 = None
+
+from settings import (
+    log,
+    PATH_OPENSSL,
+)
+
+
+TEMPLATE_FERT = '%y%m%d%H%M%SZ'
+
+#~ Llaves privadas ya cargadas, por ruta y fecha de modificación
+_private_keys = {}
+#~ Datos de certificados: por ruta (mtime, hash) y por hash los datos
+_paths = {}
+_certs = {}
+_lock = threading.Lock()
+
+
+def is_available():
+    return x509 is not None
+
+
+def get_private_key(path):
+    mtime = os.path.getmtime(path)
+    with _lock:
+        cached = _private_keys.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                key = serialization.load_pem_private_key(
+                    f.read(), password=None, backend=default_backend())
+            cached = (mtime, key)
+            _private_keys[path] = cached
+    return cached[1]
+
+
+def sign(path_pem, data):
+    """Firma SHA1 con RSA, en base64, igual que openssl dgst -sha1 -sign"""
+    key = get_private_key(path_pem)
+    firma = key.sign(data.encode('utf-8'), padding.PKCS1v15(), hashes.SHA1())
+    return base64.b64encode(firma).decode('utf-8')
+
+
+def _get_serie(serial):
+    #~ El número de serie del SAT son dígitos ASCII codificados en hexadecimal
+    value = '{:X}'.format(serial)
+    if len(value) % 2:
+        value = '0' + value
+    return value[1::2]
+
+
+def _get_rfc(value):
+    #~ x500UniqueIdentifier es "RFC" o "RFC / RFC del representante"
+    return value.split('/')[0].strip()
+
+
+def _read_der(data):
+    cer = x509.load_der_x509_certificate(data, default_backend())
+    rfc = cer.subject.get_attributes_for_oid(NameOID.X500_UNIQUE_IDENTIFIER)
+    end = getattr(cer, 'not_valid_after_utc', None) or cer.not_valid_after
+    return {
+        'serie': _get_serie(cer.serial_number),
+        'rfc': _get_rfc(rfc[0].value),
+        'fert': end.strftime(TEMPLATE_FERT),
+    }
+
+
+def _read_openssl(path_cer):
+    args = [PATH_OPENSSL, 'x509', '-inform', 'DER', '-in', path_cer,
+        '-noout', '-serial', '-subject', '-enddate']
+    lines = subprocess.check_output(args).decode().splitlines()
+    values = dict(l.split('=', 1) for l in lines if '=' in l)
+    rfc = re.search(r'x500UniqueIdentifier\s*=\s*"?([^,"]+)', values['subject'])
+    return {
+        'serie': _get_serie(int(values['serial'], 16)),
+        'rfc': _get_rfc(rfc.group(1)),
+        'fert': parser.parse(values['notAfter']).strftime(TEMPLATE_FERT),
+    }
+
+
+def get_cer_data(path_cer):
+    """Serie, RFC y fecha de vencimiento del certificado de la FIEL
+
+    El certificado se lee una sola vez por proceso, los datos se guardan en
+    memoria por hash del archivo y se vuelven a leer si cambia su fecha de
+    modificación. Regresa un diccionario vacío si no se pudo leer.
+    """
+    try:
+        mtime = os.path.getmtime(path_cer)
+        with _lock:
+            cached = _paths.get(path_cer)
+            if cached is not None and cached[0] == mtime:
+                return _certs[cached[1]].copy()
+
+        with open(path_cer, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha256(data).hexdigest()
+        with _lock:
+            values = _certs.get(key)
+        if values is None:
+            if is_available():
+                values = _read_der(data)
+            else:
+                values = _read_openssl(path_cer)
+
+        with _lock:
+            _certs[key] = values
+            _paths[path_cer] = (mtime, key)
+        return values.copy()
+    except Exception as e:
+        log.error(e)
+        return {}
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from settings import (
+    log,
+    ASYNC_LIMIT,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    CIRCUIT_FAILURES,
+    CIRCUIT_RESET,
+    CONCURRENCY_INITIAL,
+    CONCURRENCY_MIN,
+    TIMEOUT,
+    TIMEOUT_MIN,
+    TRY_COUNT,
+)
+
+
+#~ Respuestas del servidor que vale la pena reintentar
+RETRY_STATUS = (429, 500, 502, 503, 504)
+#~ Una respuesta es lenta si tarda más que este factor de la latencia media
+SLOW_FACTOR = 2
+#~ Segundos para calcular el rendimiento y mínimo entre dos reducciones
+THROUGHPUT_WINDOW = 60
+DECREASE_INTERVAL = 1
+#~ Resultado de cada petición para el limitador
+OK = 'ok'
+SLOW = 'lento'
+OVERLOAD = 'saturado'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Segundos de espera antes del intento attempt + 1, con variación"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def endpoint(url, method='get'):
+    parts = urlsplit(url)
+    return '{} {}{}'.format(method.upper(), parts.netloc, parts.path)
+
+
+class AdaptiveLimiter(object):
+    """Límite adaptable (AIMD) de peticiones simultáneas
+
+    Si el límite se está usando y las respuestas son normales, sube en uno
+    por cada ventana de peticiones completas; con tiempos agotados o
+    errores del servidor se reduce a la mitad, a lo más una vez por
+    segundo. Sirve para hilos (acquire) y para asyncio (acquire_async).
+    """
+
+    def __init__(self, initial=CONCURRENCY_INITIAL, minimum=CONCURRENCY_MIN,
+        maximum=ASYNC_LIMIT):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = float(min(self.maximum, max(self.minimum, initial)))
+        self._active = 0
+        self._waiters = deque()
+        self._completed = deque()
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def active(self):
+        return self._active
+
+    def set_maximum(self, maximum):
+        """Cambia el máximo, por ejemplo al número de hilos que lo usan"""
+        with self._lock:
+            self.maximum = max(self.minimum, maximum)
+            self._limit = min(self._limit, self.maximum)
+            self._grant()
+        return
+
+    def _available(self):
+        return self._active < int(self._limit)
+
+    def _grant(self):
+        while self._waiters and self._available():
+            self._active += 1
+            self._waiters.popleft()()
+        return
+
+    def acquire(self):
+        with self._lock:
+            if self._available() and not self._waiters:
+                self._active += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event.set)
+        event.wait()
+        return
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._available() and not self._waiters:
+                self._active += 1
+                return
+            future = loop.create_future()
+            self._waiters.append(lambda: loop.call_soon_threadsafe(
+                self._wake, future))
+        await future
+        return
+
+    def _wake(self, future):
+        #~ Si la tarea se canceló mientras esperaba, se devuelve el lugar
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+        return
+
+    def release(self, outcome=''):
+        now = time.monotonic()
+        with self._lock:
+            used = self._active >= int(self._limit)
+            self._active -= 1
+            if outcome in (OK, SLOW):
+                self._completed.append(now)
+            if outcome == OK and used:
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            elif outcome == OVERLOAD and \
+                now - self._last_decrease >= DECREASE_INTERVAL:
+                self._limit = max(self.minimum, self._limit / 2)
+                self._last_decrease = now
+                msg = 'El SAT está saturado, peticiones simultáneas: ' \
+                    '{}'.format(int(self._limit))
+                log.debug(msg)
+            self._grant()
+        return
+
+    def throughput(self):
+        """Peticiones completas por segundo en la última ventana"""
+        now = time.monotonic()
+        with self._lock:
+            while self._completed and \
+                now - self._completed[0] > THROUGHPUT_WINDOW:
+                self._completed.popleft()
+            count = len(self._completed)
+            if not count:
+                return 0.0
+            seconds = min(THROUGHPUT_WINDOW, max(1, now - self._completed[0]))
+        return count / seconds
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'throughput': self.throughput(),
+        }
+
+
+class HttpPolicy(object):
+    """Reintentos, tiempos de espera y corte de circuito de las peticiones
+
+    El tiempo de espera de cada método y URL (sin parámetros) se calcula con
+    la latencia observada, como el RTO de TCP, entre TIMEOUT_MIN y TIMEOUT, y
+    se duplica con cada tiempo agotado. Después de CIRCUIT_FAILURES fallas
+    seguidas no se hacen más peticiones durante CIRCUIT_RESET segundos.
+    Todas las peticiones pasan por el mismo AdaptiveLimiter. Se comparte
+    entre hilos.
+    """
+
+    def __init__(self, tries=TRY_COUNT, limiter=None):
+        self.tries = max(1, tries)
+        self.limiter = limiter or AdaptiveLimiter()
+        self._latency = {}
+        self._failures = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def timeout(self, url, method='get'):
+        with self._lock:
+            values = self._latency.get(endpoint(url, method))
+        if values is None:
+            return TIMEOUT
+        return values[2]
+
+    def _timeout(self, srtt, rttvar):
+        return min(TIMEOUT, max(TIMEOUT_MIN, srtt + 4 * rttvar))
+
+    def success(self, url, seconds, method='get'):
+        """Registra la latencia, regresa OK o SLOW para el limitador"""
+        key = endpoint(url, method)
+        outcome = OK
+        with self._lock:
+            values = self._latency.get(key)
+            if values is None:
+                srtt, rttvar = seconds, seconds / 2
+            else:
+                srtt, rttvar, _ = values
+                if seconds > SLOW_FACTOR * srtt:
+                    outcome = SLOW
+                rttvar = 0.75 * rttvar + 0.25 * abs(srtt - seconds)
+                srtt = 0.875 * srtt + 0.125 * seconds
+            self._latency[key] = (srtt, rttvar, self._timeout(srtt, rttvar))
+            if self._failures >= CIRCUIT_FAILURES:
+                log.info('El SAT responde de nuevo')
+            self._failures = 0
+        return outcome
+
+    def failure(self, url, timeout=False, method='get'):
+        """Registra la falla, regresa OVERLOAD para el limitador"""
+        key = endpoint(url, method)
+        with self._lock:
+            if timeout and key in self._latency:
+                srtt, rttvar, value = self._latency[key]
+                self._latency[key] = (srtt, rttvar, min(TIMEOUT, value * 2))
+            self._failures += 1
+            if self._failures == CIRCUIT_FAILURES:
+                msg = 'El SAT no responde, se suspenden las peticiones ' \
+                    '{} segundos'.format(CIRCUIT_RESET)
+                log.error(msg)
+            if self._failures >= CIRCUIT_FAILURES:
+                self._open_until = time.monotonic() + CIRCUIT_RESET
+        return OVERLOAD
+
+    def check(self):
+        """Lanza CircuitOpen si el circuito está abierto"""
+        with self._lock:
+            if time.monotonic() < self._open_until:
+                raise CircuitOpen('El SAT no responde, intenta más tarde')
+        return
+
+    def delays(self):
+        """Espera antes de cada reintento, el primer intento no espera"""
+        yield 0
+        for attempt in range(self.tries - 1):
+            yield backoff(attempt)
+
+    def call(self, url, func, retry=(), timeouts=(), method='get'):
+        """Ejecuta func(timeout) con reintentos
+
+        func hace la petición y regresa la respuesta, se reintenta con las
+        excepciones en retry y con las respuestas con estado RETRY_STATUS,
+        las de timeouts además aumentan el tiempo de espera de la URL.
+        method solo separa la latencia, un GET rápido no acorta el tiempo
+        de espera de un POST lento a la misma URL.
+        Regresa la última respuesta o lanza la última excepción.
+        """
+        error = None
+        response = None
+        for delay in self.delays():
+            time.sleep(delay)
+            self.check()
+            outcome = ''
+            self.limiter.acquire()
+            try:
+                start = time.monotonic()
+                response = func(self.timeout(url, method))
+                error = None
+                if getattr(response, 'status_code', 200) in RETRY_STATUS:
+                    outcome = self.failure(url, method=method)
+                    continue
+                outcome = self.success(url, time.monotonic() - start, method)
+                return response
+            except retry as e:
+                error = e
+                outcome = self.failure(url, isinstance(e, timeouts), method)
+                log.debug('{}: {}'.format(type(e).__name__, url))
+            finally:
+                self.limiter.release(outcome)
+
+        if error is not None:
+            raise error
+        return response
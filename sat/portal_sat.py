@@ -11,30 +11,47 @@
 # for more details.
 
 import base64
+import bisect
 import calendar
 import datetime
+import json
+import math
 import os
+import re
 import subprocess
 import sys
 import threading
+import time
 from collections import deque
+from concurrent import futures
 from copy import deepcopy
+from html import unescape
 from html.parser import HTMLParser
 from uuid import UUID
-from xml.etree import ElementTree as ET
 
 import requests
 from requests import Session, exceptions, adapters
 
-from .db import previous_download, update_date_download, save_search
+from . import async_download
+from . import fiel
+from .policy import AdaptiveLimiter, CircuitOpen, HttpPolicy, RETRY_STATUS
+from .stream import CHUNK_SIZE, FileStream, XMLStream
+from .db import previous_download, update_date_download, save_search, \
+    get_coverage, update_date_cancel, save_xml
 from settings import (
     log,
+    ASYNC_LIMIT,
+    DOWNLOAD_WORKERS,
     NAME_CER,
     OS,
     PATH_OPENSSL,
-    TIMEOUT,
-    TRY_COUNT,
+    RECENT_DAYS,
+    SESSION_CACHE,
+    SESSION_PATH,
+    SESSION_TTL,
     VERIFY_CERT,
+    VERIFY_SEARCH,
+    XML_STORAGE,
 )
 
 
@@ -95,14 +112,13 @@ class Filters(object):
         self.uuid = str(args.get('uuid', ''))
         self.stop = False
         self.hour = False
-        self.minute = False
         self._init_values(args)
 
     def __str__(self):
         if self.uuid:
             msg = 'Descargar por UUID'
         elif self.hour:
-            msg = 'Descargar por HORA'
+            msg = 'Descargar por RANGO'
         elif self.day:
             msg = 'Descargar por DIA'
         else:
@@ -134,6 +150,8 @@ class Filters(object):
         rfc_receptor = args.get('rfc_emisor', '')
         if self.emitidas:
             rfc_receptor = args.get('rfc_receptor', '')
+        #~ Búsqueda con filtros adicionales, no cuenta todo el periodo
+        self.partial = bool(rfc_receptor) or type_cfdi != '-1'
 
         script_manager = 'ctl00$MainContent$UpnlBusqueda|ctl00$MainContent$BtnBusqueda'
         self._post = {
@@ -215,7 +233,14 @@ class Filters(object):
         return self._post
 
 
-class Invoice(HTMLParser):
+class Invoice(object):
+    """Extrae los documentos de la tabla de resultados del portal
+
+    Recorre solo la sección de resultados con expresiones compiladas en vez
+    de pasar toda la respuesta por HTMLParser. Regresa en invoices las
+    mismas tuplas (uuid, valores) y en not_found y limit el estado de la
+    búsqueda.
+    """
     START_PAGE = 'ContenedorDinamico'
     URL = 'https://portalcfdi.facturaelectronica.sat.gob.mx/'
     END_PAGE = 'ctl00_MainContent_pageNavPosition'
@@ -223,132 +248,137 @@ class Invoice(HTMLParser):
     NOT_RECORDS = 'ctl00_MainContent_PnlNoResultados'
     TEMPLATE_DATE = '%Y-%m-%dT%H:%M:%S'
 
+    RE_DIV = re.compile(r'<div\b([^>]*)>', re.IGNORECASE)
+    RE_ROW_END = re.compile(r'</tr\s*>', re.IGNORECASE)
+    RE_TAGS = re.compile(r'<(td|span|img)\b([^>]*)>([^<]*)', re.IGNORECASE)
+    RE_ATTRS = re.compile(
+        r'([a-zA-Z_:][-a-zA-Z0-9_:.]*)\s*=\s*'
+        r'(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+    FIELDS = {
+        3: 'rfc_emisor',
+        4: 'emisor',
+        5: 'rfc_receptor',
+        6: 'receptor',
+        7: 'date_cfdi',
+        8: 'date_timbre',
+        9: 'rfc_pac',
+        10: 'total',
+        11: 'tipo',
+        12: 'estatus',
+        13: 'date_cancel',
+    }
+
     def __init__(self):
-        super().__init__()
-        self._is_div_page = False
-        self._col = 0
-        self._current_tag = ''
-        self._last_link = ''
-        self._last_link_pdf = ''
-        self._last_uuid = ''
-        self._last_status = ''
-        self._last_date_cfdi = ''
-        self._last_date_timbre = ''
-        self._last_pac = ''
-        self._last_total = ''
-        self._last_type = ''
-        self._last_date_cancel = ''
-        self._last_emisor_rfc = ''
-        self._last_emisor = ''
-        self._last_receptor_rfc = ''
-        self._last_receptor = ''
         self.invoices = []
         self.not_found = False
         self.limit = False
 
-    def handle_starttag(self, tag, attrs):
-        self._current_tag = tag
-        if tag == 'div':
-            attrib = dict(attrs)
-            if 'id' in attrib and attrib['id'] == self.NOT_RECORDS \
-                and 'inline' in attrib['style']:
+    def _attrs(self, text):
+        attrs = {}
+        for m in self.RE_ATTRS.finditer(text):
+            value = m.group(2)
+            if value is None:
+                value = m.group(3)
+            if value is None:
+                value = m.group(4)
+            if '&' in value:
+                value = unescape(value)
+            attrs[m.group(1).lower()] = value
+        return attrs
+
+    def _date(self, value):
+        return datetime.datetime.fromisoformat(value)
+
+    def _row(self, html):
+        col = 0
+        row = {}
+        link = ''
+        link_pdf = ''
+        for m in self.RE_TAGS.finditer(html):
+            tag = m.group(1).lower()
+            if tag == 'td':
+                col += 1
+            elif tag == 'img':
+                attrib = self._attrs(m.group(2))
+                if attrib.get('class') == 'BtnDescarga' and \
+                    attrib.get('name') == 'BtnDescarga':
+                    link = attrib['onclick'].split("'")[1]
+                elif attrib.get('class') == 'BtnRecuperaAcuse':
+                    link_pdf = attrib['onclick'].split("'")[1]
+            else:
+                data = m.group(3).strip()
+                if not data:
+                    continue
+                if col == 2:
+                    try:
+                        UUID(data)
+                        row['uuid'] = data
+                    except ValueError:
+                        pass
+                elif col in self.FIELDS:
+                    if '&' in data:
+                        data = unescape(data)
+                    row[self.FIELDS[col]] = data
+
+        uuid = row.get('uuid', '')
+        if not uuid:
+            return
+
+        url_xml = ''
+        if link:
+            url_xml = '{}{}'.format(self.URL, link)
+        url_pdf = ''
+        if link_pdf:
+            url_pdf = '{}{}'.format(self.URL, link_pdf)
+        date_cancel = None
+        if row.get('date_cancel'):
+            date_cancel = self._date(row['date_cancel'])
+        total = row.get('total', '').replace('$', '').replace(',', '')
+        invoice = (uuid,
+            {
+                'url': url_xml,
+                'acuse': url_pdf,
+                'estatus': row.get('estatus', ''),
+                'date_cfdi': self._date(row.get('date_cfdi', '')),
+                'date_timbre': self._date(row.get('date_timbre', '')),
+                'date_cancel': date_cancel,
+                'rfc_pac': row.get('rfc_pac', ''),
+                'total': float(total),
+                'tipo': row.get('tipo', '').lower(),
+                'emisor': row.get('emisor', ''),
+                'rfc_emisor': row.get('rfc_emisor', ''),
+                'receptor': row.get('receptor', ''),
+                'rfc_receptor': row.get('rfc_receptor', ''),
+            }
+        )
+        self.invoices.append(invoice)
+        return
+
+    def feed(self, html):
+        start = -1
+        end = len(html)
+        for m in self.RE_DIV.finditer(html):
+            attrib = m.group(1)
+            if not 'id' in attrib:
+                continue
+            attrib = self._attrs(attrib)
+            div_id = attrib.get('id', '')
+            if div_id == self.NOT_RECORDS and 'inline' in attrib.get('style', ''):
                 self.not_found = True
-            elif 'id' in attrib and attrib['id'] == self.LIMIT_RECORDS:
+            elif div_id == self.LIMIT_RECORDS:
                 self.limit = True
-            elif 'id' in attrib and attrib['id'] == self.START_PAGE:
-                self._is_div_page = True
-            elif 'id' in attrib and attrib['id'] == self.END_PAGE:
-                self._is_div_page = False
-        elif self._is_div_page and tag == 'td':
-            self._col +=1
-        elif tag == 'img':
-            attrib = dict(attrs)
-            if 'class' in attrib and attrib['class'] == 'BtnDescarga' and \
-                'name' in attrib and attrib['name'] == 'BtnDescarga':
-                self._last_link = attrib['onclick'].split("'")[1]
-            elif 'class' in attrib and attrib['class'] == 'BtnRecuperaAcuse':
-                self._last_link_pdf = attrib['onclick'].split("'")[1]
-
-    def handle_endtag(self, tag):
-        if self._is_div_page and tag == 'tr':
-            if self._last_uuid:
-                url_xml = ''
-                if self._last_link:
-                    url_xml = '{}{}'.format(self.URL, self._last_link)
-                url_pdf = ''
-                if self._last_link_pdf:
-                    url_pdf = '{}{}'.format(self.URL, self._last_link_pdf)
-
-                date_cancel = None
-                if self._last_date_cancel:
-                    date_cancel = datetime.datetime.strptime(
-                        self._last_date_cancel, self.TEMPLATE_DATE)
-                invoice = (self._last_uuid,
-                    {
-                        'url': url_xml,
-                        'acuse': url_pdf,
-                        'estatus': self._last_status,
-                        'date_cfdi': datetime.datetime.strptime(
-                            self._last_date_cfdi, self.TEMPLATE_DATE),
-                        'date_timbre': datetime.datetime.strptime(
-                            self._last_date_timbre, self.TEMPLATE_DATE),
-                        'date_cancel': date_cancel,
-                        'rfc_pac': self._last_pac,
-                        'total': float(self._last_total),
-                        'tipo': self._last_type,
-                        'emisor': self._last_emisor,
-                        'rfc_emisor': self._last_emisor_rfc,
-                        'receptor': self._last_receptor,
-                        'rfc_receptor': self._last_receptor_rfc,
-                    }
-                )
-                self.invoices.append(invoice)
-            self._last_link = ''
-            self._last_link_pdf = ''
-            self._last_uuid = ''
-            self._last_status = ''
-            self._last_date_cancel = ''
-            self._last_emisor_rfc = ''
-            self._last_emisor = ''
-            self._last_receptor_rfc = ''
-            self._last_receptor = ''
-            self._last_date_cfdi = ''
-            self._last_date_timbre = ''
-            self._last_pac = ''
-            self._last_total = ''
-            self._last_type = ''
-            self._col = 0
-
-    def handle_data(self, data):
-        if self._is_div_page and self._current_tag == 'span':
-            if self._col == 2:
-                try:
-                    UUID(data)
-                    self._last_uuid = data
-                except ValueError:
-                    pass
-            elif self._col == 3 and data.split():
-                self._last_emisor_rfc = data.strip()
-            elif self._col == 4 and data.split():
-                self._last_emisor = data.strip()
-            elif self._col == 5 and data.split():
-                self._last_receptor_rfc = data.strip()
-            elif self._col == 6 and data.split():
-                self._last_receptor = data.strip()
-            elif self._col == 7 and data.split():
-                self._last_date_cfdi = data.strip()
-            elif self._col == 8 and data.split():
-                self._last_date_timbre = data.strip()
-            elif self._col == 9 and data.split():
-                self._last_pac = data.strip()
-            elif self._col == 10 and data.split():
-                self._last_total = data.strip().replace('$', '').replace(',', '')
-            elif self._col == 11 and data.split():
-                self._last_type = data.strip().lower()
-            elif self._col == 12 and data.split():
-                self._last_status = data.strip()
-            elif self._col == 13 and data.split():
-                self._last_date_cancel = data.strip()
+            elif div_id == self.START_PAGE and start < 0:
+                start = m.end()
+            elif div_id == self.END_PAGE and start >= 0 and end == len(html):
+                end = m.start()
+
+        if start < 0:
+            return
+
+        rows = self.RE_ROW_END.split(html[start:end])
+        for row in rows[:-1]:
+            self._row(row)
+        return
 
 
 class PortalSAT(object):
@@ -369,6 +399,11 @@ class PortalSAT(object):
     URL_LOGOUT = URL_PORTAL + 'logout.aspx?salir=y'
     DIR_EMITIDAS = 'emitidas'
     DIR_RECIBIDAS = 'recibidas'
+    #~ Máximo de registros que regresa el portal por búsqueda
+    MAX_RECORDS = 500
+    #~ Máximo de segmentos para el tramo sin documentos observados, con más
+    #~ se hacen búsquedas vacías cuando los documentos están concentrados
+    MAX_SPLIT = 3
 
     def __init__(self, rfc, target, sin):
         self._rfc = rfc
@@ -378,6 +413,12 @@ class PortalSAT(object):
         self.only_search = False
         self.only_test = False
         self.sin_sub = sin
+        self.workers = DOWNLOAD_WORKERS
+        self.async_download = False
+        self.incremental = False
+        self.verify = VERIFY_SEARCH
+        self.keep_session = SESSION_CACHE and bool(rfc)
+        self.xml_storage = XML_STORAGE
         self._init_values(target)
 
     def _init_values(self, target):
@@ -387,8 +428,41 @@ class PortalSAT(object):
         self._emitidas = False
         self._current_year = datetime.datetime.now().year
         self._session = Session()
-        a = adapters.HTTPAdapter(pool_connections=512, pool_maxsize=512, max_retries=5)
+        #~ Los reintentos los controla HttpPolicy, no el adaptador
+        a = adapters.HTTPAdapter(pool_connections=512, pool_maxsize=512)
         self._session.mount('https://', a)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._async = None
+        self._policy = HttpPolicy(
+            limiter=AdaptiveLimiter(maximum=max(1, self.workers)))
+        self._coverage = {}
+        return
+
+    def _get_pool(self):
+        #~ Emitidas y recibidas descargan en hilos distintos, ambas comparten
+        #~ el mismo grupo de trabajadores durante toda la sesión
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = futures.ThreadPoolExecutor(
+                    max_workers=max(1, self.workers))
+        return self._pool
+
+    def _get_async(self):
+        with self._pool_lock:
+            if self._async is None:
+                self._async = async_download.AsyncDownloader(
+                    self._session, policy=self._policy)
+        return self._async
+
+    def _close_pool(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+            if self._async is not None:
+                self._async.close()
+                self._async = None
         return
 
     def _create_folders(self, target):
@@ -428,30 +502,45 @@ class PortalSAT(object):
             'ctl00$MainContent$UpnlBusqueda|ctl00$MainContent$RdoFechas'
         return post
 
-    def _response(self, url, method='get', headers={}, data={}):
-        #~ log.debug('URL: {}'.format(url))
+    def _request(self, url, method='get', data=None):
+        def send(timeout):
+            return self._session.request(method, url, data=data,
+                timeout=timeout, verify=VERIFY_CERT)
+
+        #~ Un POST solo se repite si no llegó al servidor
+        retry = (exceptions.Timeout, exceptions.ConnectionError)
+        if method != 'get':
+            retry = (exceptions.ConnectionError,)
+        return self._policy.call(url, send, retry, exceptions.Timeout, method)
+
+    def _send(self, url, method='get', data=None):
+        """Respuesta completa de la petición o None, el error queda en
+        self.error"""
         try:
-            if method == 'get':
-                result = self._session.get(url, timeout=TIMEOUT,
-                    verify=VERIFY_CERT)
-            else:
-                result = self._session.post(url, data=data,
-                    timeout=TIMEOUT, verify=VERIFY_CERT)
+            result = self._request(url, method, data)
             msg = '{} {} {}'.format(result.status_code, method.upper(), url)
             log.debug(msg)
-            return result.text
+            return result
+        except CircuitOpen as e:
+            msg = str(e)
         except exceptions.Timeout:
             msg = 'Tiempo de espera agotado'
-            self.not_network = True
-            log.error(msg)
-            self.error = msg
-            return ''
-        except exceptions.ConnectionError:
+        except exceptions.RequestException:
             msg = 'Revisa la conexión a Internet'
-            self.not_network = True
-            log.error(msg)
-            self.error = msg
+        self.not_network = True
+        log.error(msg)
+        self.error = msg
+        return None
+
+    def _response(self, url, method='get', headers={}, data={}):
+        #~ log.debug('URL: {}'.format(url))
+        if method == 'get':
+            result = self._send(url)
+        else:
+            result = self._send(url, method, data)
+        if result is None:
             return ''
+        return result.text
 
     def _read_form(self, html, form=''):
         if form == 'login':
@@ -504,7 +593,9 @@ class PortalSAT(object):
 
         URL_LOGIN = 'https://cfdiau.sat.gob.mx/nidp/wsfed/ep?id=SATUPCFDiCon&sid=0&option=credential&sid=0'
         REFERER = 'https://cfdiau.sat.gob.mx/nidp/wsfed_redir_cont_portalcfdi.jsp?wa=wsignin1.0&wtrealm={}'
-        result = self._session.get(self.URL_MAIN)
+        result = self._send(self.URL_MAIN)
+        if result is None:
+            return ''
 
         url_redirect = result.history[-1].headers['Location']
         self._session.headers['Host'] = self.HOST
@@ -515,10 +606,41 @@ class PortalSAT(object):
         result = self._response(URL_LOGIN, 'post')
 
         url = 'https://cfdiau.sat.gob.mx/nidp/jcaptcha.jpg'
-        result = self._session.get(url, timeout=TIMEOUT)
+        result = self._send(url)
+        if result is None:
+            return ''
 
+        self._prewarm()
         return resolve(result.content, from_script)
 
+    def _open_connection(self, url):
+        #~ Se usa el adaptador directo para no tocar las cookies de la sesión,
+        #~ la conexión queda abierta en el pool para la siguiente petición
+        try:
+            headers = {'User-Agent': self.BROWSER}
+            request = requests.Request('HEAD', url, headers=headers).prepare()
+            adapter = self._session.get_adapter(url)
+            response = adapter.send(request, timeout=self._policy.timeout(url),
+                verify=VERIFY_CERT)
+            response.content
+            msg = 'Conexión preparada: {}'.format(url)
+            log.debug(msg)
+        except Exception as e:
+            log.debug(str(e))
+        return
+
+    def _prewarm(self):
+        """Abre en segundo plano las conexiones TLS de los siguientes pasos
+
+        Mientras se resuelve el captcha o se firma con la FIEL, se hace el
+        saludo TLS con el control de acceso y el portal.
+        """
+        for url in (self.URL_CONTROL, self.URL_PORTAL):
+            th = threading.Thread(
+                target=self._open_connection, args=(url,), daemon=True)
+            th.start()
+        return
+
     def login(self, ciec, from_script):
         HOST = 'cfdicontribuyentes.accesscontrol.windows.net'
         URL_CONTROL1 = 'https://cfdiau.sat.gob.mx/nidp/wsfed/ep?sid=0'
@@ -572,12 +694,7 @@ class PortalSAT(object):
         self.is_connect = True
         return True
 
-    def _get_data_cert(self, path_fiel, name):
-        path = os.path.join(path_fiel, '{}.txt'.format(name))
-        return open(path).read()
-
-    def _get_token(self, path_fiel, co):
-        path_pem = os.path.join(path_fiel, NAME_CER.format('pem'))
+    def _sign_openssl(self, path_fiel, path_pem, co):
         path_co = os.path.join(path_fiel, 'tmp')
         with open(path_co, 'w', encoding='utf-8') as f:
             f.write(co)
@@ -589,22 +706,38 @@ class PortalSAT(object):
             '"{1}" enc -base64 -A'.format(path_co, PATH_OPENSSL, path_pem, cmd)
 
         firma = subprocess.check_output(args, shell=True).decode()
-        firma = base64.b64encode(firma.encode('utf-8')).decode('utf-8')
-        co = base64.b64encode(co.encode('utf-8')).decode('utf-8')
-        data = '{}#{}'.format(co, firma).encode('utf-8')
-        token = base64.b64encode(data).decode('utf-8')
 
         try:
             os.remove(path_co)
         except:
             pass
 
+        return firma
+
+    def _sign(self, path_fiel, co):
+        """Firma SHA1 con RSA, en base64, con la llave de la FIEL
+
+        Con cryptography instalado se firma en el mismo proceso, si no se
+        usa el ejecutable de openssl.
+        """
+        path_pem = os.path.join(path_fiel, NAME_CER.format('pem'))
+        if not fiel.is_available():
+            return self._sign_openssl(path_fiel, path_pem, co)
+        return fiel.sign(path_pem, co)
+
+    def _get_token(self, path_fiel, co):
+        firma = self._sign(path_fiel, co)
+        firma = base64.b64encode(firma.encode('utf-8')).decode('utf-8')
+        co = base64.b64encode(co.encode('utf-8')).decode('utf-8')
+        data = '{}#{}'.format(co, firma).encode('utf-8')
+        token = base64.b64encode(data).decode('utf-8')
         return token
 
     def _make_data_form(self, path_fiel, values):
-        rfc = self._get_data_cert(path_fiel, 'rfc')
-        serie = self._get_data_cert(path_fiel, 'serie')
-        fert = self._get_data_cert(path_fiel, 'fert')
+        cer = fiel.get_cer_data(os.path.join(path_fiel, NAME_CER.format('cer')))
+        rfc = cer['rfc']
+        serie = cer['serie']
+        fert = cer['fert']
         co = '{}|{}|{}'.format(values['tokenuuid'], rfc, serie)
         token = self._get_token(path_fiel, co)
         keys = ('credentialsRequired', 'guid', 'ks', 'urlApplet')
@@ -618,7 +751,9 @@ class PortalSAT(object):
         REFERER = 'https://cfdiau.sat.gob.mx/nidp/wsfed/ep?id=SATUPCFDiCon&sid=0&option=credential&sid=0'
 
         url_login = 'https://cfdiau.sat.gob.mx/nidp/app/login?id=SATx509Custom&sid=0&option=credential&sid=0'
-        result = self._session.get(self.URL_MAIN)
+        result = self._send(self.URL_MAIN)
+        if result is None:
+            return False
 
         url_redirect = result.history[-1].headers['Location']
         self._session.headers['Host'] = self.HOST
@@ -628,6 +763,7 @@ class PortalSAT(object):
         self._session.headers['Referer'] = REFERER.format(url_redirect)
         result = self._response(url_login, 'post')
 
+        self._prewarm()
         values = self._read_form(result, 'login')
         data = self._make_data_form(path_fiel, values)
         headers = self._get_headers(self.HOST, self.REFERER)
@@ -653,6 +789,85 @@ class PortalSAT(object):
         self.is_connect = True
         return True
 
+    def _path_session(self):
+        return os.path.join(SESSION_PATH, '{}.json'.format(self._rfc))
+
+    def _save_session(self):
+        cookies = [{
+            'name': c.name,
+            'value': c.value,
+            'domain': c.domain,
+            'path': c.path,
+            'secure': c.secure,
+            'expires': c.expires,
+        } for c in self._session.cookies]
+        data = {'expires': time.time() + SESSION_TTL, 'cookies': cookies}
+
+        #~ Las cookies equivalen a la contraseña, solo el usuario puede leerlas
+        os.makedirs(SESSION_PATH, exist_ok=True)
+        path = self._path_session()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        return
+
+    def _delete_session(self):
+        try:
+            os.remove(self._path_session())
+        except FileNotFoundError:
+            pass
+        return
+
+    def restore_session(self):
+        """Usa la sesión guardada del RFC si sigue activa en el SAT"""
+        if not self.keep_session:
+            return False
+
+        try:
+            with open(self._path_session()) as f:
+                data = json.load(f)
+        except OSError:
+            return False
+        except ValueError:
+            data = None
+
+        #~ Un archivo incompleto o modificado se descarta, se usa el login
+        try:
+            expires = float(data.get('expires', 0))
+            cookies = [(c['name'], c['value'], c.get('domain', ''),
+                c.get('path', '/'), bool(c.get('secure')), c.get('expires'))
+                for c in data.get('cookies', [])]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            msg = 'El archivo de la sesión guardada no es válido'
+            log.debug(msg)
+            self._delete_session()
+            return False
+
+        if not cookies or expires < time.time():
+            self._delete_session()
+            return False
+
+        for name, value, domain, path, secure, expires in cookies:
+            self._session.cookies.set(name, value, domain=domain, path=path,
+                secure=secure, expires=expires)
+        self._session.headers['User-Agent'] = self.BROWSER
+
+        #~ Una sesión vencida redirige a la página de identificación
+        html = self._response(self.URL_CONSULTA)
+        if not 'RdoTipoBusqueda' in html:
+            msg = 'La sesión guardada ya no es válida'
+            log.debug(msg)
+            self._delete_session()
+            self._session.cookies.clear()
+            self.error = ''
+            self.not_network = False
+            return False
+
+        msg = 'Se restauró la sesión en el SAT'
+        log.info(msg)
+        self.is_connect = True
+        return True
+
     def _merge(self, list1, list2):
         result = list1.copy()
         result.update(list2)
@@ -732,45 +947,84 @@ class PortalSAT(object):
 
         return tuple(filters)
 
-    def _segment_filter(self, filters):
+    def _split_range(self, start, end, parts):
+        """Divide [start, end] en parts segmentos de la misma duración"""
+        one = datetime.timedelta(seconds=1)
+        seconds = int((end - start).total_seconds()) + 1
+        parts = min(parts, seconds)
+        bounds = [start + datetime.timedelta(seconds=seconds * i // parts)
+            for i in range(parts + 1)]
+        return [(s, e - one) for s, e in zip(bounds, bounds[1:])]
+
+    def _split_dates(self, date_from, date_to, dates):
+        """Divide el rango según la densidad de los documentos observados
+
+        Cada segmento acumula aproximadamente la misma cantidad de
+        documentos, así los periodos con poco movimiento quedan en un solo
+        segmento y solo se divide más fino donde hay volumen. Los cortes se
+        hacen a la mitad entre dos documentos consecutivos, al segundo.
+        Si el portal regresa los documentos ordenados por fecha, los
+        observados solo cubren parte del rango; lo que queda antes y
+        después se divide suponiendo la misma densidad.
+        """
+        one = datetime.timedelta(seconds=1)
+        dates = sorted(d.replace(microsecond=0)
+            for d in dates if date_from <= d <= date_to)
+        changes = [i for i in range(1, len(dates)) if dates[i] > dates[i-1]]
+
+        if not changes:
+            middle = date_from + (date_to - date_from) / 2
+            middle = middle.replace(microsecond=0)
+            return [(date_from, middle), (middle + one, date_to)]
+
+        half = self.MAX_RECORDS // 2
+        parts = max(2, math.ceil(len(dates) / half))
+        size = math.ceil(len(dates) / parts)
+        cuts = []
+        count = 0
+        for i in changes:
+            if i - count >= size:
+                cuts.append(i)
+                count = i
+        if not cuts:
+            cuts.append(min(changes, key=lambda i: abs(i - len(dates) // 2)))
+
+        #~ Documentos por segundo en el tramo observado
+        rate = len(dates) / ((dates[-1] - dates[0]).total_seconds() + 1)
+
+        def gap(start, end):
+            seconds = (end - start).total_seconds() + 1
+            parts = min(self.MAX_SPLIT, math.ceil(seconds * rate / half))
+            if start > end or parts < 2:
+                return []
+            return self._split_range(start, end, parts)
+
+        segments = gap(date_from, dates[0] - one)
+        start = date_from
+        if segments:
+            start = dates[0]
+        tail = gap(dates[-1] + one, date_to)
+        for i in cuts:
+            end = dates[i-1] + (dates[i] - dates[i-1]) / 2
+            end = end.replace(microsecond=0)
+            segments.append((start, end))
+            start = end + one
+        if tail:
+            segments.append((start, dates[-1]))
+            segments.extend(tail)
+        else:
+            segments.append((start, date_to))
+        return segments
+
+    def _segment_filter(self, filters, invoices=()):
         new_filters = []
         if filters.stop:
             return new_filters
         date = filters.date_from
         date_to = filters.date_to
 
-        if filters.minute:
-            for m in range(10):
-                nf = deepcopy(filters)
-                nf.stop = True
-                nf.date_from = date + datetime.timedelta(minutes=m)
-                nf.date_to = date + datetime.timedelta(minutes=m+1)
-                new_filters.append(nf)
-        elif filters.hour:
-            minutes = tuple(range(0, 60, 10)) + (0,)
-            minutes = tuple(zip(minutes, minutes[1:]))
-            for m in minutes:
-                nf = deepcopy(filters)
-                nf.minute = True
-                nf.date_from = date + datetime.timedelta(minutes=m[0])
-                nf.date_to = date + datetime.timedelta(minutes=m[1])
-                if m[0] == 50:
-                    nf.date_to = nf.date_to.replace(
-                        hour=nf.date_to.hour+1, minute=0, second=0)
-                new_filters.append(nf)
-        elif filters.day:
-            hours = (0,) + tuple(range(4,22)) + (23,)
-            hours = tuple(zip(hours, hours[1:]))
-            for h in hours:
-                nf = deepcopy(filters)
-                nf.hour = True
-                nf.date_from = date + datetime.timedelta(hours=h[0])
-                nf.date_to = date + datetime.timedelta(hours=h[1])
-                if h[1] == 23:
-                    nf.date_to = nf.date_to.replace(
-                        hour=23, minute=59, second=59, microsecond=0)
-                new_filters.append(nf)
-        else:
+        #~ En recibidas el portal solo permite buscar por mes o por día
+        if not filters.emitidas and not filters.day:
             last_day = calendar.monthrange(date.year, date.month)[1]
             for d in range(last_day):
                 nf = deepcopy(filters)
@@ -781,6 +1035,16 @@ class PortalSAT(object):
                 new_filters.append(nf)
                 if date_to == nf.date_to:
                     break
+            return new_filters
+
+        dates = [values['date_cfdi'] for _, values in invoices]
+        for start, end in self._split_dates(date, date_to, dates):
+            nf = deepcopy(filters)
+            nf.hour = True
+            nf.date_from = start
+            nf.date_to = end
+            nf.stop = start >= end
+            new_filters.append(nf)
         return new_filters
 
     def _get_post(self, html):
@@ -803,6 +1067,12 @@ class PortalSAT(object):
             post = self._merge(post, f.get_post())
             headers = self._get_headers(self.PORTAL, url_search)
             html = self._response(url_search, 'post', headers, post)
+            #~ Sin respuesta no se sabe si hay documentos, no es lo mismo
+            #~ que un periodo vacío
+            if not html:
+                msg = 'No se pudo consultar el filtro: {}'.format(str(f))
+                log.error(msg)
+                continue
             not_found, limit, invoices = self._get_download_links(html)
             if not_found:
                 msg = '\n\tNo se encontraron documentos en el filtro:' \
@@ -821,7 +1091,39 @@ class PortalSAT(object):
         post = self._get_post(result)
         return values, post
 
+    def _load_coverage(self):
+        before = datetime.datetime.now() - datetime.timedelta(days=RECENT_DAYS)
+        for recibidas in (True, False):
+            intervals = get_coverage(self._rfc, recibidas, self.verify,
+                before, self.MAX_RECORDS)
+            self._coverage[recibidas] = (
+                [i[0] for i in intervals], [i[1] for i in intervals])
+        return
+
+    def _is_verified(self, filters):
+        if filters.uuid or filters.partial:
+            return False
+        starts, ends = self._coverage.get(not filters.emitidas, ((), ()))
+        i = bisect.bisect_right(starts, filters.date_from) - 1
+        return i >= 0 and ends[i] >= filters.date_to
+
+    def _skip_verified(self, filters):
+        if not self.incremental:
+            return filters
+        pending = []
+        for f in filters:
+            if self._is_verified(f):
+                msg = 'Periodo verificado previamente, se omite: {}'.format(f)
+                log.info(msg)
+            else:
+                pending.append(f)
+        return pending
+
     def _search_recibidas(self, filters):
+        filters = self._skip_verified(filters)
+        if not filters:
+            return
+
         url_search = self.URL_RECEPTOR
         values, post_source = self._change_to_date(url_search)
 
@@ -831,16 +1133,30 @@ class PortalSAT(object):
             post = self._merge(post, post_source)
             headers = self._get_headers(self.PORTAL, url_search, True)
             html = self._response(url_search, 'post', headers, post)
+            #~ Sin respuesta no se sabe si hay documentos, no es lo mismo
+            #~ que un periodo vacío
+            if not html:
+                msg = 'No se pudo consultar el filtro: {}'.format(str(f))
+                log.error(msg)
+                continue
             not_found, limit, invoices = self._get_download_links(html)
             if not_found or not invoices:
                 msg = '\n\tNo se encontraron documentos en el filtro:' \
                     '\n\t{}'.format(str(f))
                 log.info(msg)
+                #~ Los periodos vacíos también se guardan para no volver a
+                #~ buscarlos en modo incremental
+                if not_found:
+                    self._save_search(f, self.DIR_RECIBIDAS, ())
             else:
                 self._download(invoices, limit, f)
         return
 
     def _search_emitidas(self, filters):
+        filters = self._skip_verified(filters)
+        if not filters:
+            return
+
         url_search = self.URL_EMISOR
         values, post_source = self._change_to_date(url_search)
 
@@ -850,19 +1166,46 @@ class PortalSAT(object):
             post = self._merge(post, post_source)
             headers = self._get_headers(self.PORTAL, url_search, True)
             html = self._response(url_search, 'post', headers, post)
+            #~ Sin respuesta no se sabe si hay documentos, no es lo mismo
+            #~ que un periodo vacío
+            if not html:
+                msg = 'No se pudo consultar el filtro: {}'.format(str(f))
+                log.error(msg)
+                continue
             not_found, limit, invoices = self._get_download_links(html)
             if not_found or not invoices:
                 msg = '\n\tNo se encontraron documentos en el filtro:' \
                     '\n\t{}'.format(str(f))
                 log.info(msg)
+                #~ Los periodos vacíos también se guardan para no volver a
+                #~ buscarlos en modo incremental
+                if not_found:
+                    self._save_search(f, self.DIR_EMITIDAS, ())
             else:
                 self._download(invoices, limit, f, self.DIR_EMITIDAS)
         return
 
     def search(self, opt):
+        self._search(opt)
+        if opt['tipo'] != 'r':
+            self._update_cancel()
+        return
+
+    def _update_cancel(self):
+        #~ Los acuses se revisan una sola vez por ejecución, al final de
+        #~ todos los filtros y solo los nuevos o modificados
+        path = os.path.join(self._folder, self.DIR_EMITIDAS)
+        if os.path.isdir(path):
+            update_date_cancel(path, self._rfc)
+        return
+
+    def _search(self, opt):
         filters_e = ()
         filters_r = ()
 
+        if self.incremental and not opt['uuid']:
+            self._load_coverage()
+
         if opt['tipo'] == 'e' and not opt['uuid']:
             filters_e = self._get_filters(opt, True)
             self._search_emitidas(filters_e)
@@ -890,12 +1233,21 @@ class PortalSAT(object):
         tr.join()
         return
 
+    def _save_search(self, filters, folder, invoices):
+        #~ Con filtros adicionales no se revisó todo el periodo, no se guarda
+        #~ para que el modo incremental no lo omita
+        if filters is None or filters.uuid or filters.partial:
+            return
+        downloads = sum(1 for _, values in invoices if values['url'])
+        save_search(
+            self._rfc, folder == self.DIR_RECIBIDAS,
+            filters.date_from, filters.date_to, len(invoices), downloads)
+        return
+
     def _download(self, invoices, limit=False, filters=None, folder=DIR_RECIBIDAS):
-        if filters is not None and not filters.uuid:
-            save_search(
-                self._rfc, folder == self.DIR_RECIBIDAS,
-                filters.date_from, filters.date_to, len(invoices))
+        self._save_search(filters, folder, invoices)
 
+        found = invoices
         if filters is not None and not filters.uuid:
             invoices = previous_download(invoices)
 
@@ -903,18 +1255,13 @@ class PortalSAT(object):
             msg = '\n\tTodos los documentos han sido previamente ' \
                 'descargados para el filtro.\n\t{}'.format(str(filters))
             log.info(msg)
-
-            path = ''
-            if folder == self.DIR_EMITIDAS:
-                path = os.path.join(self._folder, folder)
-            update_date_download([], path, self._rfc)
             return
 
         if invoices and not self.only_search:
             self._thread_download(invoices, folder, filters)
 
         if limit:
-            sf = self._segment_filter(filters)
+            sf = self._segment_filter(filters, found)
             if folder == self.DIR_RECIBIDAS:
                 self._search_recibidas(sf)
             else:
@@ -931,57 +1278,72 @@ class PortalSAT(object):
                 os.makedirs(path)
         return os.path.join(path, name)
 
-    def _parse_xml(self, path):
-        try:
-            xml = ET.parse(path).getroot()
-            return True
-        except Exception as e:
-            msg = 'Error al parsear: {}'.format(path)
-        return False
+    def _make_path_pdf(self, uuid):
+        name = '{}.pdf'.format(uuid)
+        return os.path.join(self._folder, self.DIR_EMITIDAS, name)
+
+    def _download_round(self, jobs):
+        #~ Por encima del número de trabajadores el límite no cambia nada
+        if self.async_download and async_download.is_available():
+            self._policy.limiter.set_maximum(ASYNC_LIMIT)
+            return self._get_async().download(jobs)
+
+        if self.async_download:
+            msg = 'Instala aiohttp para usar la descarga asíncrona'
+            log.error(msg)
+            self.async_download = False
+
+        self._policy.limiter.set_maximum(self.workers)
+        pool = self._get_pool()
+        total = len(jobs)
+        tasks = {uuid: pool.submit(self._get_xml, uuid, data, current, total)
+            for current, (uuid, data) in enumerate(jobs, 1)}
+        futures.wait(tasks.values())
+        return {uuid: t.result() for uuid, t in tasks.items()
+            if t.result() is not None}
 
     def _thread_download(self, invoices, folder, filters):
-        threads = []
-        paths = {}
         for_download = invoices[:]
-        current = 1
         total = len(for_download)
 
-        for i in range(TRY_COUNT):
+        for delay in self._policy.delays():
+            time.sleep(delay)
+            jobs = []
             for uuid, values in for_download:
-                #~ name = '{}.xml'.format(uuid)
-                #~ path_xml = os.path.join(self._folder, folder, name)
-                path_xml = self._make_path_xml(uuid, folder, values['date_cfdi'])
-                paths[uuid] = path_xml
+                path_xml = ''
+                if self.xml_storage != 'bd':
+                    path_xml = self._make_path_xml(
+                        uuid, folder, values['date_cfdi'])
                 data = {
                     'url': values['url'],
                     'path_xml': path_xml,
+                    'keep': self.xml_storage != 'disco',
                     'acuse': values['acuse'],
+                    'path_pdf': self._make_path_pdf(uuid),
                 }
-                th = threading.Thread(
-                    target=self._get_xml, args=(uuid, data, current, total))
-                th.start()
-                threads.append(th)
-                current += 1
+                jobs.append((uuid, data))
+            results = self._download_round(jobs)
 
-            for t in threads:
-                t.join()
-
-            #~ Valid download
+            #~ Cada XML se valida mientras se descarga, solo se vuelven a
+            #~ encolar los que fallaron. Si solo falló el acuse se encola sin
+            #~ url para no descargar de nuevo el XML
             not_saved = []
             uuids = []
+            documents = []
             for uuid, values in for_download:
-                p = paths[uuid]
-                #~ if os.path.exists(p) and os.path.getsize(p):
-                if self._parse_xml(p):
-                    uuids.append(uuid)
-                else:
+                if not uuid in results:
                     not_saved.append((uuid, values))
-            path = ''
-            if folder == self.DIR_EMITIDAS:
-                path = os.path.join(self._folder, folder)
-            update_date_download(uuids, path, self._rfc)
-            for_download = not_saved[:]
-            current = 1
+                    continue
+                size, sha256, data, acuse = results[uuid]
+                if size is not None:
+                    uuids.append(uuid)
+                if data is not None:
+                    documents.append((uuid, sha256, data))
+                if not acuse:
+                    not_saved.append((uuid, dict(values, url='')))
+            save_xml(documents)
+            update_date_download(uuids)
+            for_download = not_saved
             total = len(for_download)
             if not for_download:
                 break
@@ -991,64 +1353,141 @@ class PortalSAT(object):
             log.info(msg)
         return
 
-    def _get_xml(self, uuid, values, current, count):
-        msg = 'Descargando UUID: {} - {} de {}'.format(uuid, current, count)
-        log.info(msg)
+    def _fetch(self, url, stream):
+        """Descarga url en stream, regresa el error del último intento o ''"""
+        #~ Reintenta continuando desde el último byte recibido
+        policy = self._policy
+        error = ''
+        for delay in policy.delays():
+            time.sleep(delay)
+            try:
+                policy.check()
+            except CircuitOpen as e:
+                return str(e)
 
-        for i in range(TRY_COUNT):
+            outcome = ''
+            policy.limiter.acquire()
             try:
-                r = self._session.get(values['url'], stream=True, timeout=TIMEOUT)
-                if r.status_code == 200:
-                    with open(values['path_xml'], 'wb') as f:
-                        for chunk in r.iter_content(1024):
-                            f.write(chunk)
-                if values['acuse']:
-                    self._save_acuse(uuid, values['acuse'])
-                return
+                start = time.monotonic()
+                #~ Con with la conexión regresa al pool en cualquier salida
+                with self._session.get(url, stream=True,
+                    timeout=policy.timeout(url), headers=stream.headers()) as r:
+                    if r.status_code in RETRY_STATUS:
+                        outcome = policy.failure(url)
+                        error = 'El SAT respondió {}'.format(r.status_code)
+                        continue
+                    outcome = policy.success(url, time.monotonic() - start)
+                    if not stream.accept(r.status_code, r.headers):
+                        error = 'Respuesta no válida del SAT: {}'.format(
+                            r.status_code)
+                        if r.status_code in (206, 416):
+                            continue
+                        return error
+                    with stream:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            stream.feed(chunk)
+                if not stream.incomplete:
+                    return ''
+                error = 'Descarga incompleta: {} de {} bytes'.format(
+                    stream.size, stream.total)
+                log.debug(error)
             except exceptions.Timeout:
-                log.debug('Timeout')
-                continue
+                outcome = policy.failure(url, True)
+                error = 'Tiempo de espera agotado'
+                log.debug(error)
+            except (exceptions.ConnectionError,
+                exceptions.ChunkedEncodingError) as e:
+                outcome = policy.failure(url)
+                error = 'Error de conexión: {}'.format(e)
+                log.debug(error)
+            finally:
+                policy.limiter.release(outcome)
+        return error
+
+    def _get_xml(self, uuid, values, current, count):
+        """(tamaño, sha256, datos, acuse) o None si no se pudo descargar el XML
+
+        Sin url solo se descarga el acuse, tamaño, sha256 y datos son None.
+        acuse es False si hay que volver a intentar descargarlo.
+        """
+        result = (None, None, None)
+        if values['url']:
+            msg = 'Descargando UUID: {} - {} de {}'.format(uuid, current, count)
+            log.info(msg)
+            try:
+                xml = XMLStream(values['path_xml'], values['keep'])
+                error = self._fetch(values['url'], xml)
+                if error:
+                    msg = 'No se pudo descargar el documento: {} - {}'.format(
+                        uuid, error)
+                    log.error(msg)
+                    return None
+                result = self._check_xml(uuid, xml)
             except Exception as e:
                 log.error(str(e))
-                return
-        msg = 'Tiempo de espera agotado para el documento: {}'.format(uuid)
+                return None
+            if result is None:
+                return None
+
+        acuse = True
+        if values['acuse']:
+            acuse = self._save_acuse(uuid, values['acuse'])
+        return result + (acuse,)
+
+    def _check_xml(self, uuid, xml):
+        if xml.close():
+            return (xml.size, xml.sha256, xml.data)
+        msg = 'XML inválido: {} - {}'.format(uuid, xml.error)
         log.error(msg)
-        return
+        return None
 
     def _save_acuse(self, uuid, url_pdf):
+        """Descarga el acuse de cancelación, regresa True si se guardó"""
         msg = 'Descargando acuse del UUID: {}'.format(uuid)
         log.info(msg)
 
-        name = '{}.pdf'.format(uuid)
-        path_pdf = os.path.join(self._folder, self.DIR_EMITIDAS, name)
-
-        for i in range(2):
-            with open(path_pdf, 'wb') as handle:
-                try:
-                    response = self._session.get(url_pdf, stream=True, timeout=TIMEOUT)
-                    if not response.ok:
-                        return
-                    for block in response.iter_content(1024):
-                        if not block:
-                            break
-                        handle.write(block)
-                    return
-                except exceptions.Timeout:
-                    log.debug('Timeout')
-                    continue
-                except Exception as e:
-                    log.error(str(e))
-                    return
-        return
+        try:
+            pdf = FileStream(self._make_path_pdf(uuid))
+            error = self._fetch(url_pdf, pdf)
+            if error:
+                msg = 'No se pudo descargar el acuse: {} - {}'.format(
+                    uuid, error)
+                log.error(msg)
+                return False
+            if not pdf.close():
+                msg = 'Acuse inválido: {} - {}'.format(uuid, pdf.error)
+                log.error(msg)
+                return False
+        except Exception as e:
+            log.error(str(e))
+            return False
+        return True
 
     def _get_download_links(self, html):
         parser = Invoice()
         parser.feed(html)
         return parser.not_found, parser.limit, parser.invoices
 
+    @property
+    def concurrency(self):
+        """Límite actual de peticiones simultáneas y rendimiento por segundo"""
+        return self._policy.limiter.stats()
+
     def logout(self):
         msg = 'Cerrando sessión en el SAT'
         log.debug(msg)
+        self._close_pool()
+        stats = self.concurrency
+        msg = 'Peticiones simultáneas: {}, rendimiento: {:.1f} por ' \
+            'segundo'.format(stats['limit'], stats['throughput'])
+        log.debug(msg)
+        if self.keep_session and self.is_connect:
+            self._save_session()
+            self.is_connect = False
+            msg = 'Sesión guardada para la siguiente ejecución'
+            log.info(msg)
+            return
+
         respuesta = self._response(self.URL_LOGOUT)
         self.is_connect = False
         msg = 'Sesión cerrada en el SAT'
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+#~ Este módulo se importa en los procesos del pool, no debe depender de la
+#~ base de datos ni de settings
+
+import string
+from xml.etree import ElementTree as ET
+
+
+#~ Bloque que se lee del XML hasta tener todos los valores de la plantilla
+READ_SIZE = 16 * 1024
+#~ Atributos que no se usan en los nombres y hacen más lento el parser
+SKIP = ('sello', 'Sello', 'certificado', 'Certificado')
+CHARS = str.maketrans({c: '_' for c in " ',.-/"})
+TAGS = {
+    'Comprobante': 'comprobante',
+    'Emisor': 'emisor',
+    'Receptor': 'receptor',
+    'TimbreFiscalDigital': 'timbre',
+    'Nomina': 'nomina',
+}
+#~ El timbre y la nómina sobrescriben la versión del comprobante, si la
+#~ plantilla la usa se lee todo el documento
+VERSION = frozenset(('version', 'Version'))
+NS_NOMINA = ('http://www.sat.gob.mx/nomina', 'http://www.sat.gob.mx/nomina12')
+#~ Comprobante, Emisor y Receptor solo de estos espacios de nombres, otros
+#~ complementos (comercio exterior) tienen nodos con el mismo nombre
+NS_CFDI = ('http://www.sat.gob.mx/cfd/2', 'http://www.sat.gob.mx/cfd/3',
+    'http://www.sat.gob.mx/cfd/4')
+NS_TIMBRE = 'http://www.sat.gob.mx/TimbreFiscalDigital'
+
+
+class CompiledTemplate(object):
+    """Plantilla de nombres, se analiza una sola vez para todos los archivos"""
+
+    def __init__(self, template):
+        self.template = template
+        self.keys = frozenset(name.split('.')[0].split('[')[0]
+            for _, name, _, _ in string.Formatter().parse(template) if name)
+
+    def format(self, data):
+        name = self.template.format(**data)
+        return '{}.xml'.format(name.translate(CHARS))
+
+
+def _split(tag):
+    ns, _, name = tag[1:].partition('}')
+    return ns, name
+
+
+def _add(data, attrib, replace=False):
+    for k, v in attrib.items():
+        if k in SKIP:
+            continue
+        if replace:
+            data[k] = v
+        else:
+            data.setdefault(k, v)
+    return
+
+
+def _node(data, kind, attrib, ns):
+    if kind == 'comprobante' and ns in NS_CFDI:
+        _add(data, attrib)
+        data['serie'] = attrib.get('serie', attrib.get('Serie', ''))
+        data['folio'] = attrib.get('folio', attrib.get('Folio', '0'))
+        data['fecha'] = attrib.get('fecha', attrib.get('Fecha', ''))
+    elif kind in ('emisor', 'receptor') and ns in NS_NOMINA:
+        _add(data, attrib, True)
+    elif kind in ('emisor', 'receptor') and ns in NS_CFDI:
+        data[kind] = attrib.get('nombre', attrib.get('Nombre', ''))
+        data[kind + '_rfc'] = attrib.get('rfc', attrib.get('Rfc', ''))
+    elif (kind == 'timbre' and ns == NS_TIMBRE) or \
+        (kind == 'nomina' and ns in NS_NOMINA):
+        _add(data, attrib, True)
+    return
+
+
+def read_values(path, keys):
+    """Atributos del XML para la plantilla, deja de leer al tener todos"""
+    data = {}
+    full = bool(keys & VERSION)
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    with open(path, 'rb') as f:
+        while full or not keys <= data.keys():
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                ns, tag = _split(element.tag)
+                if event == 'end':
+                    #~ Conceptos y addendas no se usan, se libera la memoria
+                    element.clear()
+                    continue
+                kind = TAGS.get(tag)
+                if kind is not None:
+                    _node(data, kind, element.attrib, ns)
+    return data
+
+
+def _clean(data):
+    try:
+        data['folio'] = int(data.get('folio', 0))
+    except ValueError:
+        pass
+    data['fecha'] = data.get('fecha', '').partition('T')[0]
+    if 'NumEmpleado' in data:
+        try:
+            data['NumEmpleado'] = int(data['NumEmpleado'])
+        except ValueError:
+            pass
+    return data
+
+
+def get_name(path, template):
+    """Nuevo nombre del archivo con la plantilla: (True, nombre) o (False, error)"""
+    if isinstance(template, str):
+        template = CompiledTemplate(template)
+    try:
+        data = _clean(read_values(path, template.keys))
+    except Exception as e:
+        msg = 'Error al parsear: {}'.format(path)
+        return False, msg
+
+    try:
+        return True, template.format(data)
+    except (KeyError, IndexError, ValueError) as e:
+        msg = 'Falta el dato {} en: {}'.format(e, path)
+        return False, msg
+
+
+def new_name(args):
+    """Para el pool: (ruta, plantilla) -> (ruta, correcto, nombre o error)"""
+    path, template = args
+    result, name = get_name(path, template)
+    return path, result, name
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import itertools
+from collections import deque
+from concurrent import futures
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+from requests import Session, exceptions, adapters
+
+from .policy import AdaptiveLimiter, CircuitOpen, HttpPolicy
+from settings import (
+    log,
+    STATUS_WORKERS,
+    URL_STATUS,
+    VERIFY_CERT,
+)
+
+
+SOAP = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope
+    xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <soap:Header/>
+    <soap:Body>
+    <Consulta xmlns="http://tempuri.org/">
+        <expresionImpresa>{}</expresionImpresa>
+    </Consulta>
+    </soap:Body>
+</soap:Envelope>"""
+EXPRESSION = '?re={}&rr={}&tt={}&id={}'
+HEADERS = {
+    'SOAPAction': '"http://tempuri.org/IConsultaCFDIService/Consulta"',
+    'Content-type': 'text/xml; charset="UTF-8"',
+}
+#~ Elemento de la respuesta: campo del resultado
+FIELDS = {
+    'Estado': 'estado',
+    'CodigoEstatus': 'codigo',
+    'EsCancelable': 'cancelable',
+    'EstatusCancelacion': 'estatus_cancelacion',
+}
+
+
+def parse(data):
+    """Campos de FIELDS en la respuesta del servicio, None si no hay Estado"""
+    result = {}
+    for element in ET.fromstring(data).iter():
+        name = element.tag.rpartition('}')[2]
+        if name in FIELDS:
+            result[FIELDS[name]] = (element.text or '').strip()
+    if not result.get('estado'):
+        return None
+    return result
+
+
+class StatusClient(object):
+    """Consulta el estado de CFDI en el servicio del SAT
+
+    Todas las consultas usan la misma sesión, con hasta workers conexiones
+    persistentes, y pasan por un HttpPolicy propio: reintentos, corte de
+    circuito y límite adaptable de consultas simultáneas (máximo workers).
+    url se puede cambiar por un servicio local para pruebas.
+    """
+
+    def __init__(self, url=URL_STATUS, workers=STATUS_WORKERS, policy=None,
+        verify=VERIFY_CERT):
+        self.url = url
+        self.workers = max(1, workers)
+        self._policy = policy or HttpPolicy(limiter=AdaptiveLimiter(
+            initial=self.workers, maximum=self.workers))
+        self._verify = verify
+        self._session = Session()
+        self._session.headers.update(HEADERS)
+        a = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self._session.mount('https://', a)
+        self._session.mount('http://', a)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._session.close()
+        return
+
+    def query(self, emisor, receptor, total, uuid):
+        """Estado de un CFDI: diccionario con los campos de FIELDS o None"""
+        expression = EXPRESSION.format(emisor, receptor, total, uuid)
+        data = SOAP.format(escape(expression)).encode('utf-8')
+
+        def send(timeout):
+            return self._session.post(self.url, data=data, timeout=timeout,
+                verify=self._verify)
+
+        try:
+            response = self._policy.call(self.url, send,
+                (exceptions.ConnectionError, exceptions.Timeout),
+                exceptions.Timeout, 'post')
+            response.raise_for_status()
+            return parse(response.content)
+        except CircuitOpen as e:
+            log.debug(str(e))
+        except (exceptions.RequestException, ET.ParseError) as e:
+            msg = 'Error al consultar el estado de: {}'.format(uuid)
+            log.error(msg)
+            log.debug(str(e))
+        return None
+
+    def query_many(self, invoices):
+        """Estado de varios CFDI: iterable de (emisor, receptor, total, uuid)
+
+        Genera (uuid, resultado) en el mismo orden. Solo hay en curso el
+        doble de consultas que workers, el iterable puede ser muy grande.
+        """
+        invoices = iter(invoices)
+        with futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = deque()
+
+            def submit(count):
+                for invoice in itertools.islice(invoices, count):
+                    future = executor.submit(self.query, *invoice)
+                    pending.append((invoice[3], future))
+                return
+
+            submit(self.workers * 2)
+            while pending:
+                uuid, future = pending.popleft()
+                submit(1)
+                yield uuid, future.result()
+        return
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import hashlib
+import os
+import re
+from xml.etree import ElementTree as ET
+
+
+#~ Tamaño de bloque al leer las respuestas del SAT
+CHUNK_SIZE = 64 * 1024
+#~ Extensión de las descargas en curso, se renombran al terminar
+TMP_EXT = '.part'
+RE_RANGE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+class _Target(object):
+    #~ Sin métodos start/end/data el parser solo valida, no construye el árbol
+
+    def close(self):
+        return None
+
+
+class FileStream(object):
+    """Descarga a un archivo temporal que se renombra al terminar
+
+    Los bytes se escriben en path.part mientras se calcula su SHA-256, con
+    keep también se conservan en memoria. Si la descarga se interrumpe,
+    headers() regresa el encabezado Range para continuar desde el último
+    byte recibido, incluso en otra ejecución. close() solo mueve el archivo
+    a path si llegó completo.
+    """
+
+    def __init__(self, path='', keep=False):
+        self.path = path
+        self._path_tmp = ''
+        if path:
+            self._path_tmp = path + TMP_EXT
+        self._keep = keep
+        self._file = None
+        self._clear()
+        self._load()
+        if self.error:
+            self.reset()
+
+    def _clear(self):
+        self._hash = hashlib.sha256()
+        self._chunks = None
+        if self._keep:
+            self._chunks = []
+        self.size = 0
+        self.total = None
+        self.error = ''
+        return
+
+    def _load(self):
+        #~ Parte descargada en un intento o ejecución anterior
+        if not self._path_tmp or not os.path.exists(self._path_tmp):
+            return
+        with open(self._path_tmp, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self._update(chunk)
+        return
+
+    def reset(self):
+        self._close_file()
+        self._clear()
+        if self._path_tmp and os.path.exists(self._path_tmp):
+            os.remove(self._path_tmp)
+        return
+
+    def headers(self):
+        if not self.size:
+            return {}
+        #~ Sin compresión, para que los bytes coincidan con los ya guardados
+        return {
+            'Range': 'bytes={}-'.format(self.size),
+            'Accept-Encoding': 'identity',
+        }
+
+    def accept(self, status, headers):
+        """Revisa la respuesta, False si no se puede usar"""
+        encoded = headers.get('Content-Encoding', 'identity') != 'identity'
+        if status == 200:
+            #~ El servidor ignoró Range, se descarga de nuevo desde el inicio
+            if self.size:
+                self.reset()
+            self.total = None
+            if not encoded and headers.get('Content-Length', '').isdigit():
+                self.total = int(headers['Content-Length'])
+            return True
+
+        if status == 206 and not encoded:
+            match = RE_RANGE.match(headers.get('Content-Range', ''))
+            if match and int(match.group(1)) == self.size:
+                self.total = None
+                if match.group(2) != '*':
+                    self.total = int(match.group(2))
+                return True
+
+        if status in (206, 416):
+            self.reset()
+        return False
+
+    def __enter__(self):
+        if self._path_tmp:
+            mode = 'wb'
+            if self.size:
+                mode = 'ab'
+            self._file = open(self._path_tmp, mode)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close_file()
+        #~ Si no se escribió todo lo recibido, no se puede continuar
+        if self._path_tmp and os.path.exists(self._path_tmp) and \
+            os.path.getsize(self._path_tmp) != self.size:
+            self.reset()
+        return False
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
+
+    def _update(self, data):
+        if self._chunks is not None:
+            self._chunks.append(data)
+        self.size += len(data)
+        self._hash.update(data)
+        return
+
+    def feed(self, data):
+        if self._file is not None:
+            self._file.write(data)
+        self._update(data)
+        return
+
+    @property
+    def incomplete(self):
+        return self.total is not None and self.size < self.total
+
+    def _check(self):
+        if not self.size:
+            self.error = 'Documento vacío'
+        elif self.incomplete:
+            self.error = 'Descarga incompleta: {} de {} bytes'.format(
+                self.size, self.total)
+        return not self.error
+
+    def close(self):
+        self._close_file()
+        valid = self._check()
+        if self._path_tmp and os.path.exists(self._path_tmp):
+            if valid:
+                os.replace(self._path_tmp, self.path)
+            elif not self.incomplete:
+                os.remove(self._path_tmp)
+        return valid
+
+    @property
+    def valid(self):
+        return bool(self.size) and not self.error
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    @property
+    def data(self):
+        if self._chunks is None:
+            return None
+        return b''.join(self._chunks)
+
+
+class XMLStream(FileStream):
+    """Además valida el XML mientras se descarga
+
+    Así no es necesario volver a leer el archivo para saber si está completo.
+    """
+
+    def _clear(self):
+        super()._clear()
+        self._parser = ET.XMLParser(target=_Target())
+        return
+
+    def _update(self, data):
+        super()._update(data)
+        if self.error:
+            return
+        try:
+            self._parser.feed(data)
+        except ET.ParseError as e:
+            self.error = str(e)
+        return
+
+    def _check(self):
+        if not self.error and self.size and not self.incomplete:
+            try:
+                self._parser.close()
+            except ET.ParseError as e:
+                self.error = str(e)
+        return super()._check()
@@ -11,91 +11,182 @@
 # for more details.
 
 import base64
+import collections
 import datetime
+import multiprocessing
 import os
 import re
-import subprocess
 import time
+from concurrent import futures
 from uuid import UUID
-from urllib import request
-from xml.etree import ElementTree as ET
-from dateutil import parser
 
-from .db import connect
+from . import extract
+from . import rename
+from . import status
+from .db import connect, get_companies, get_detail_sources, \
+    get_pending_documents, get_status_cache, iter_documents, \
+    iter_status_invoices, save_details, save_status, SOURCE_DB
+from .fiel import get_cer_data
+from .policy import backoff
 from .portal_sat import PortalSAT
+from conf import TOKEN
 from settings import (
     log,
+    EXTRACT_BATCH,
+    LOGIN_CANDIDATES,
     NAME_CER,
-    PATH_OPENSSL,
+    STATUS_TTL,
+    STATUS_WORKERS,
+    SYNC_PROCESSES,
     TRY_COUNT,
+    URL_STATUS,
+    XML_STORAGE,
 )
 
 
-def _call(args):
-    return subprocess.check_output(args, shell=True).decode()
+#~ CFDI por bloque al verificar su estado, se guardan al terminar cada bloque
+STATUS_BATCH = 1000
 
 
 def get_status_sat(data):
-    webservice = 'https://consultaqr.facturaelectronica.sat.gob.mx/consultacfdiservice.svc'
-    soap = """<?xml version="1.0" encoding="UTF-8"?>
-    <soap:Envelope
-        xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"
-        xmlns:xsd="http://www.w3.org/2001/XMLSchema"
-        xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-        <soap:Header/>
-        <soap:Body>
-        <Consulta xmlns="http://tempuri.org/">
-            <expresionImpresa>
-                ?re={emisor_rfc}&amp;rr={receptor_rfc}&amp;tt={total}&amp;id={uuid}
-            </expresionImpresa>
-        </Consulta>
-        </soap:Body>
-    </soap:Envelope>"""
-    data = soap.format(**data).encode('utf-8')
-    headers = {
-        'SOAPAction': '"http://tempuri.org/IConsultaCFDIService/Consulta"',
-        'Content-length': str(len(data)),
-        'Content-type': 'text/xml; charset="UTF-8"'
-    }
-    req = request.Request(url=webservice, data=data, method='POST')
-    for k, v in headers.items():
-        req.add_header(k, v)
+    """Estado de un CFDI en el SAT, para muchos CFDI usa verify_status
+
+    data tiene emisor_rfc, receptor_rfc, total y uuid.
+    """
+    with status.StatusClient(workers=1) as client:
+        result = client.query(data['emisor_rfc'], data['receptor_rfc'],
+            data['total'], data['uuid'])
+    if result is None:
+        return ''
+    return result['estado']
+
+
+def verify_status(invoices, workers=STATUS_WORKERS, ttl=STATUS_TTL,
+    url=URL_STATUS):
+    """Estado en el SAT de varios CFDI: iterable de (emisor, receptor, total,
+    uuid)
+
+    Los consultados hace menos de ttl segundos se toman de la base de datos,
+    el resto se consulta con workers conexiones y se guarda por bloques.
+    Regresa uuid -> resultado (ver sat.status.FIELDS), sin los que fallaron.
+    """
+    connect()
+    start = time.time()
+    results = {}
+    cached = 0
+    errors = 0
+    with status.StatusClient(url, workers) as client:
+        for batch in _batches(invoices, STATUS_BATCH):
+            batch = {UUID(str(i[3])): i for i in batch}
+            found = get_status_cache(batch, ttl)
+            cached += len(found)
+            missing = [(e, r, t, u) for u, (e, r, t, _) in batch.items()
+                if u not in found]
+            new = {}
+            for uuid, result in client.query_many(missing):
+                if result is None:
+                    errors += 1
+                    continue
+                new[uuid] = result
+            save_status(new)
+            results.update(found)
+            results.update(new)
+            msg = 'Estados consultados: {}'.format(len(results) + errors)
+            log.info(msg)
+
+    msg = 'Estados de CFDI: {}, de la base de datos: {}, errores: {}, ' \
+        'tiempo total: {:.1f} s'.format(
+        len(results), cached, errors, time.time() - start)
+    log.info(msg)
+    return results
+
+
+def verify_invoices(emisor='', receptor=''):
+    """Verifica el estado en el SAT de los CFDI extraídos con -ex"""
+    connect()
+    results = verify_status(iter_status_invoices(emisor, receptor))
+    totals = collections.Counter(r['estado'] for r in results.values())
+    for estado, count in sorted(totals.items()):
+        msg = '{}: {}'.format(estado, count)
+        log.info(msg)
+    return results
+
+
+def _get_portal(opt):
+    sat = PortalSAT(opt['rfc'], opt['folder'], opt['sin_subdirectorios'])
+    sat.only_search = opt['sin_descargar']
+    sat.async_download = opt.get('asincrono', False)
+    sat.incremental = opt.get('incremental', False)
+    sat.xml_storage = opt.get('xml', XML_STORAGE)
+    return sat
+
+
+def _login(sat, opt, conectar):
     try:
-        with request.urlopen(req, timeout=5) as f:
-            response = f.read().decode('utf-8')
-        result = re.search("(?s)(?<=Estado>).+?(?=</a:)", response).group()
-        return result
+        if opt['directorio_fiel']:
+            return sat.login_fiel(opt['directorio_fiel'])
+        return sat.login(opt['ciec'], conectar)
     except Exception as e:
-        log.error(str(e))
-        return ''
+        sat.error = str(e)
+        log.error(sat.error)
+        return False
+
+
+def _discard(sat):
+    if sat.is_connect:
+        sat.keep_session = False
+        sat.logout()
+    return
+
+
+def _login_parallel(opt, conectar, candidates):
+    """Identifica varias sesiones independientes y usa la primera que entra
+
+    Las demás se cierran en segundo plano conforme terminan.
+    """
+    sessions = [_get_portal(opt) for i in range(candidates)]
+    executor = futures.ThreadPoolExecutor(max_workers=candidates)
+    tasks = {executor.submit(_login, s, opt, conectar): s for s in sessions}
+    winner = None
+    for task in futures.as_completed(tasks):
+        if task.result():
+            winner = tasks[task]
+            break
+
+    for task, sat in tasks.items():
+        if sat is not winner:
+            task.add_done_callback(lambda t, sat=sat: _discard(sat))
+    executor.shutdown(wait=winner is None)
+    return winner or sessions[-1]
 
 
 def sat_download(conectar=True, **opt):
     error = 'No se pudo conectar al SAT, en el intento {}'
-    for i in range(TRY_COUNT):
-        sat = PortalSAT(opt['rfc'], opt['folder'], opt['sin_subdirectorios'])
-        sat.only_search = opt['sin_descargar']
-
-        if opt['directorio_fiel']:
-            if sat.login_fiel(opt['directorio_fiel']):
-                time.sleep(1)
-                break
-        else:
-            if sat.login(opt['ciec'], conectar):
-                time.sleep(1)
-                break
+    sat = _get_portal(opt)
+    #~ Sin intervención del usuario se pueden intentar varias sesiones a la vez
+    parallel = LOGIN_CANDIDATES > 1 and bool(opt['directorio_fiel'] or TOKEN)
+    if not sat.restore_session():
+        for i in range(TRY_COUNT):
+            if i and parallel:
+                sat = _login_parallel(opt, conectar, LOGIN_CANDIDATES)
             else:
-                msg = error.format(i + 1)
-                log.debug(msg)
+                sat = _get_portal(opt)
+                _login(sat, opt, conectar)
+            if sat.is_connect:
                 time.sleep(1)
-                if sat.not_network:
-                    log.error(sat.error)
-                    return
+                break
+
+            msg = error.format(i + 1)
+            log.debug(msg)
+            time.sleep(backoff(i))
+            if sat.not_network:
+                log.error(sat.error)
+                return sat.error
 
     if not sat.is_connect:
         sat.logout()
         log.error(sat.error)
-        return
+        return sat.error or error.format(TRY_COUNT)
 
     del opt['ciec']
     del opt['folder']
@@ -107,6 +198,236 @@ def sat_download(conectar=True, **opt):
     sat.search(opt)
     sat.logout()
 
+    return ''
+
+
+def _sync_rfc(jobs):
+    #~ Se ejecuta en un proceso independiente, los trabajos de un mismo RFC
+    #~ van en serie para no abrir dos sesiones simultáneas en el SAT
+    results = []
+    for opt in jobs:
+        start = time.time()
+        try:
+            msg = sat_download(**opt.copy())
+        except Exception as e:
+            msg = str(e)
+            log.error(msg)
+        results.append({
+            'rfc': opt['rfc'],
+            'tipo': opt['tipo'],
+            'fecha_inicial': opt['fecha_inicial'],
+            'fecha_final': opt['fecha_final'],
+            'error': msg,
+            'seconds': time.time() - start,
+        })
+    return results
+
+
+def read_jobs(path):
+    """Lee el archivo de trabajos, una línea por tarea:
+
+        RFC FECHA_INICIAL FECHA_FINAL TIPO
+
+    Las fechas usan los formatos de -fi/-ff y TIPO es t, e o r. Las líneas
+    vacías o que inician con # se ignoran.
+    """
+    jobs = []
+    with open(path) as f:
+        for i, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 4:
+                msg = 'Línea {}: se requieren RFC, fecha inicial, fecha final ' \
+                    'y tipo'.format(i)
+                return msg
+            rfc, start, end, tipo = fields
+            rfc = rfc.upper()
+            msg = validate_rfc(rfc)
+            if msg:
+                return 'Línea {}: {}'.format(i, msg)
+            start = validate_date(date_str=start)
+            end = validate_date(date_str=end)
+            if isinstance(start, str) or isinstance(end, str):
+                return 'Línea {}: Fecha de búsqueda inválida'.format(i)
+            if not tipo in ('t', 'e', 'r'):
+                return 'Línea {}: Tipo inválido'.format(i)
+            if end < start:
+                start, end = end, start
+            jobs.append({
+                'rfc': rfc,
+                'fecha_inicial': start,
+                'fecha_final': end,
+                'tipo': tipo,
+            })
+    return tuple(jobs)
+
+
+def get_jobs(opt, path=''):
+    """Combina las opciones base con las empresas dadas de alta
+
+    Sin archivo de trabajos se genera una tarea por empresa con las fechas
+    y tipo de opt. Con archivo, cada tarea debe corresponder a una empresa.
+    """
+    connect()
+    companies = {}
+    for _, rfc, name, ciec, folder in get_companies():
+        companies[rfc] = {
+            'rfc': rfc,
+            'ciec': get_ciec(ciec),
+            'folder': folder,
+        }
+
+    if path:
+        tasks = read_jobs(path)
+        if isinstance(tasks, str):
+            return tasks
+    else:
+        tasks = [{'rfc': rfc} for rfc in companies]
+
+    jobs = {}
+    for task in tasks:
+        if not task['rfc'] in companies:
+            msg = 'El RFC {} no esta dado de alta'.format(task['rfc'])
+            return msg
+        data = opt.copy()
+        data.update(companies[task['rfc']])
+        data.update(task)
+        msg = validate_folder(data['folder'])
+        if msg:
+            return '{}: {}'.format(data['rfc'], msg)
+        jobs.setdefault(data['rfc'], []).append(data)
+    return jobs
+
+
+def _sync_pool(jobs, processes):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(max_workers=max(1, processes),
+        mp_context=context) as executor:
+        tasks = {executor.submit(_sync_rfc, v): k for k, v in jobs.items()}
+        for task in futures.as_completed(tasks):
+            try:
+                results += task.result()
+            except Exception as e:
+                log.error('{}: {}'.format(tasks[task], str(e)))
+                results.append({'rfc': tasks[task], 'tipo': '',
+                    'fecha_inicial': None, 'fecha_final': None,
+                    'error': str(e), 'seconds': 0})
+    return results
+
+
+def sync_companies(jobs, processes=SYNC_PROCESSES):
+    """Sincroniza varios RFC en paralelo, un proceso por RFC a la vez
+
+    jobs es el diccionario RFC: [opciones] de get_jobs, processes es el
+    máximo de procesos simultáneos.
+    """
+    results = []
+    start = time.time()
+    if not TOKEN:
+        #~ Las empresas entran con CIEC, sin servicio de captcha hay que
+        #~ capturarlo y los procesos del pool no tienen entrada estándar
+        msg = 'Sin TOKEN en conf.py para resolver el captcha, las empresas ' \
+            'se sincronizan una por una'
+        log.warning(msg)
+        for rfc, tasks in jobs.items():
+            results += _sync_rfc(tasks)
+    else:
+        results += _sync_pool(jobs, processes)
+
+    errors = [r for r in results if r['error']]
+    for r in sorted(results, key=lambda r: r['rfc']):
+        msg = '{} - {} - {} - {} - {:.1f} s - {}'.format(r['rfc'], r['tipo'],
+            r['fecha_inicial'], r['fecha_final'], r['seconds'],
+            r['error'] or 'Correcto')
+        log.info(msg)
+    msg = 'Tareas: {}, correctas: {}, con error: {}, RFCs: {}, ' \
+        'tiempo total: {:.1f} s'.format(len(results),
+        len(results) - len(errors), len(errors), len(jobs),
+        time.time() - start)
+    log.info(msg)
+    return results
+
+
+def _batches(items, size=EXTRACT_BATCH):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _save_extracted(rows, errors):
+    for source, error in errors:
+        msg = 'Error al extraer {}: {}'.format(source, error)
+        log.error(msg)
+    save_details(rows)
+    return len(rows)
+
+
+def _extract_documents(executor):
+    total = 0
+    pending = get_pending_documents()
+    for batch in _batches(iter_documents(pending)):
+        rows = []
+        errors = []
+        results = executor.map(extract.parse_document, batch, chunksize=50)
+        for sha256, header, concepts, error in results:
+            if error:
+                errors.append((sha256, error))
+                continue
+            header.update({'source': SOURCE_DB, 'sha256': sha256})
+            rows.append((header, concepts))
+        total += _save_extracted(rows, errors)
+    return total
+
+
+def _extract_files(executor, folder):
+    total = 0
+    sources = get_detail_sources()
+    changed = []
+    for path, stat in iter_files(folder):
+        if sources.get(path) != (stat.st_mtime, stat.st_size):
+            changed.append(path)
+
+    for batch in _batches(changed):
+        rows = []
+        errors = []
+        results = executor.map(extract.parse_file, batch, chunksize=50)
+        for path, sha256, mtime, size, header, concepts, error in results:
+            if error:
+                errors.append((path, error))
+                continue
+            header.update({'source': path, 'sha256': sha256,
+                'mtime': mtime, 'size': size})
+            rows.append((header, concepts))
+        total += _save_extracted(rows, errors)
+    return total
+
+
+def extract_xml(folder, processes=SYNC_PROCESSES):
+    """Extrae a la base de datos encabezado y conceptos de los XML
+
+    Se leen los XML guardados en la base de datos y los archivos en folder,
+    solo los nuevos o que cambiaron desde la última extracción, en un pool
+    de processes procesos.
+    """
+    connect()
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(max_workers=max(1, processes),
+        mp_context=context) as executor:
+        documents = _extract_documents(executor)
+        files = _extract_files(executor, folder)
+
+    msg = 'XML extraídos, de la base de datos: {}, de archivos: {}, ' \
+        'tiempo total: {:.1f} s'.format(documents, files, time.time() - start)
+    log.info(msg)
     return
 
 
@@ -163,52 +484,6 @@ def validate_folder(path):
     return msg
 
 
-def _save(path, data):
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(data)
-    return
-
-
-def _get_cer_serie(path_cer, path_serie):
-    args = '"{}" x509 -inform DER -in {} -noout -serial'.format(
-        PATH_OPENSSL, path_cer)
-    try:
-        serie = _call(args)
-        serie = serie.split('=')[1].split('\n')[0][1::2]
-        _save(path_serie, serie)
-        return serie
-    except Exception as e:
-        log.error(e)
-        return ''
-
-
-def _get_cer_rfc(path_cer, path_rfc):
-    args = '"{}" x509 -inform DER -in {} -noout -subject'.format(
-        PATH_OPENSSL, path_cer)
-    try:
-        rfc = _call(args)
-        rfc = rfc.split('=')[7].split(',')[0].strip()
-        _save(path_rfc, rfc)
-        return rfc
-    except Exception as e:
-        log.error(e)
-        return ''
-
-
-def _get_cer_fert(path_cer, path_fert):
-    args = '"{}" x509 -inform DER -in {} -noout -enddate'.format(
-        PATH_OPENSSL, path_cer)
-    try:
-        fert = _call(args)
-        fert = parser.parse(fert.split('=')[1])
-        fert = fert.strftime('%y%m%d%H%M%SZ')
-        _save(path_fert, fert)
-        return fert
-    except Exception as e:
-        log.error(e)
-        return ''
-
-
 def validate_folder_fiel(path):
     if not os.path.exists(path):
         msg = 'No se encontró el directorio'
@@ -220,31 +495,23 @@ def validate_folder_fiel(path):
 
     path_cer = join(path, NAME_CER.format('cer'))
     path_pem = join(path, NAME_CER.format('pem'))
-    path_serie = join(path, 'serie.txt')
-    path_rfc = join(path, 'rfc.txt')
-    path_fert = join(path, 'fert.txt')
 
     if not os.path.exists(path_cer):
         msg = 'No se encontró el archivo CER'
         return msg
 
-    if not os.path.exists(path_serie):
-        serie = _get_cer_serie(path_cer, path_serie)
-        if not serie:
-            msg = 'No se pudo obtener la serie de la FIEL'
-            return msg
+    data = get_cer_data(path_cer)
+    if not data.get('serie'):
+        msg = 'No se pudo obtener la serie de la FIEL'
+        return msg
 
-    if not os.path.exists(path_rfc):
-        rfc = _get_cer_rfc(path_cer, path_rfc)
-        if not rfc:
-            msg = 'No se pudo obtener el RFC de la FIEL'
-            return msg
+    if not data.get('rfc'):
+        msg = 'No se pudo obtener el RFC de la FIEL'
+        return msg
 
-    if not os.path.exists(path_fert):
-        fert = _get_cer_fert(path_cer, path_fert)
-        if not fert:
-            msg = 'No se pudo obtener la fecha de la FIEL'
-            return msg
+    if not data.get('fert'):
+        msg = 'No se pudo obtener la fecha de la FIEL'
+        return msg
 
     if not os.path.exists(path_pem):
         msg = 'No se encontró el archivo PEM'
@@ -335,63 +602,7 @@ def validate_uuid(value):
 
 
 def get_name(path, template):
-    PRE = {
-        '2.0': '{http://www.sat.gob.mx/cfd/2}',
-        '2.2': '{http://www.sat.gob.mx/cfd/2}',
-        '3.0': '{http://www.sat.gob.mx/cfd/3}',
-        '3.2': '{http://www.sat.gob.mx/cfd/3}',
-        'TIMBRE': '{http://www.sat.gob.mx/TimbreFiscalDigital}',
-        'NOM1.1': '{http://www.sat.gob.mx/nomina}',
-        'NOM1.2': '{http://www.sat.gob.mx/nomina12}',
-        'IMP_LOCAL': '{http://www.sat.gob.mx/implocal}',
-        'IEDU': '{http://www.sat.gob.mx/iedu}',
-        'DONATARIA': '{http://www.sat.gob.mx/donat}',
-        'LEYENDAS': '{http://www.sat.gob.mx/leyendasFiscales}',
-    }
-
-    try:
-        xml = ET.parse(path).getroot()
-    except Exception as e:
-        msg = 'Error al parsear: {}'.format(path)
-        return False, msg
-
-    data = xml.attrib.copy()
-    pre = PRE[data['version']]
-    del data['sello']
-    del data['certificado']
-
-    data['serie'] = data.get('serie', '')
-    data['folio'] = int(data.get('folio', 0))
-    data['fecha'] = data['fecha'].partition('T')[0]
-
-    node = xml.find('{}Emisor'.format(pre))
-    data['emisor'] = node.attrib.get('nombre', '')
-    data['emisor_rfc'] = node.attrib['rfc']
-
-    node = xml.find('{}Receptor'.format(pre))
-    data['receptor'] = node.attrib.get('nombre', '')
-    data['receptor_rfc'] = node.attrib['rfc']
-
-    node = xml.find('{}Complemento/{}TimbreFiscalDigital'.format(
-        pre, PRE['TIMBRE']))
-    data.update(node.attrib.copy())
-
-    pre_nom = PRE['NOM1.1']
-    node = xml.find('{}Complemento/{}Nomina'.format(pre, pre_nom))
-    if node is None:
-        pre_nom = PRE['NOM1.2']
-        node = xml.find('{}Complemento/{}Nomina'.format(pre, pre_nom))
-    if not node is None:
-        data.update(node.attrib.copy())
-        node = node.find('{}Receptor'.format(pre_nom))
-        data.update(node.attrib.copy())
-        data['NumEmpleado'] = int(data.get('NumEmpleado', 0))
-
-    name = template.format(**data)
-    char = (' ', "'", ',', '.', '-', '/')
-    for c in char:
-        name = name.replace(c, '_')
-    return True, '{}.xml'.format(name)
+    return rename.get_name(path, template)
 
 
 def file_rename(source, new_name):
@@ -404,11 +615,125 @@ def file_rename(source, new_name):
         return False
 
 
-def get_files(path):
-    paths = []
-    pattern = re.compile('\.xml', re.IGNORECASE)
-    cwd = os.getcwd()
-    for folder, _, files in os.walk(path):
-        paths += [os.path.join(cwd, folder, f) for f in files if pattern.search(f)]
-    return tuple(paths)
+def _find_conflicts(names):
+    #~ Destinos repetidos o que ya existen, os.rename los sobrescribiría
+    targets = {}
+    for source, name in names:
+        target = os.path.join(os.path.dirname(source), name)
+        if target != source:
+            targets.setdefault(target, []).append(source)
+    conflicts = {}
+    for target, paths in targets.items():
+        if len(paths) > 1 or os.path.exists(target):
+            conflicts[target] = paths
+    return targets, conflicts
+
+
+def rename_files(folder, template, processes=SYNC_PROCESSES):
+    """Renombra los XML de folder con la plantilla en paralelo
+
+    Los nombres se calculan en un pool de processes procesos, los destinos
+    repetidos o que ya existen no se renombran y se reportan como
+    conflictos. Regresa un diccionario con los totales y los conflictos.
+    """
+    start = time.time()
+    compiled = rename.CompiledTemplate(template)
+    names = []
+    errors = []
+    context = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(max_workers=max(1, processes),
+        mp_context=context) as executor:
+        jobs = ((path, compiled) for path in get_files(folder))
+        for path, result, name in executor.map(
+            rename.new_name, jobs, chunksize=500):
+            if result:
+                names.append((path, name))
+            else:
+                errors.append(name)
+                log.error(name)
+
+    targets, conflicts = _find_conflicts(names)
+    unchanged = sum(1 for path, name in names
+        if os.path.basename(path) == name)
+    renamed = 0
+    for target, paths in targets.items():
+        if target in conflicts:
+            continue
+        if file_rename(paths[0], os.path.basename(target)):
+            renamed += 1
+        else:
+            msg = 'No se pudo renombrar: {}'.format(paths[0])
+            errors.append(msg)
+            log.error(msg)
+
+    for target, paths in conflicts.items():
+        msg = 'Conflicto, {} ya existe o se repite en: {}'.format(
+            target, ', '.join(paths))
+        log.error(msg)
+
+    msg = 'Archivos renombrados: {}, sin cambio: {}, conflictos: {}, ' \
+        'errores: {}, tiempo total: {:.1f} s'.format(renamed,
+        unchanged, len(conflicts), len(errors),
+        time.time() - start)
+    log.info(msg)
+    return {'renamed': renamed, 'conflicts': conflicts, 'errors': errors}
+
+
+def iter_files(path, ext='.xml'):
+    """Archivos con la extensión ext bajo path, genera (ruta absoluta, stat)"""
+    ext = ext.lower()
+    pending = [os.path.abspath(path)]
+    while pending:
+        folder = pending.pop()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.name.lower().endswith(ext) and entry.is_file():
+                        yield entry.path, entry.stat()
+        except OSError as e:
+            msg = 'No se pudo leer el directorio: {}'.format(folder)
+            log.error(msg)
+            log.debug(str(e))
+    return
+
+
+def _read_manifest(path):
+    files = {}
+    if not os.path.exists(path):
+        return files
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            name, size, mtime = line.rstrip('\n').rsplit('\t', 2)
+            files[name] = (int(size), int(mtime))
+    return files
+
+
+def get_files(path, manifest=''):
+    """Genera las rutas absolutas de los XML bajo path
+
+    Con manifest (ruta de un archivo) solo genera los nuevos o modificados
+    desde el recorrido anterior y, al terminar, guarda en el manifest
+    tamaño y fecha de modificación de todos los encontrados.
+    """
+    if not manifest:
+        for path_file, stat in iter_files(path):
+            yield path_file
+        return
 
+    previous = _read_manifest(manifest)
+    path_tmp = '{}.tmp'.format(manifest)
+    try:
+        with open(path_tmp, 'w', encoding='utf-8') as f:
+            for path_file, stat in iter_files(path):
+                current = (stat.st_size, stat.st_mtime_ns)
+                f.write('{}\t{}\t{}\n'.format(path_file, *current))
+                if previous.get(path_file) != current:
+                    yield path_file
+        os.replace(path_tmp, manifest)
+    finally:
+        #~ Si no se recorrió todo, el manifest anterior sigue siendo válido
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    return
@@ -48,6 +48,77 @@ TIMEOUT = 120
 #~ - Descargar faltantes de la lista obtenida al buscar
 TRY_COUNT = 3
 
+#~ Política de todas las peticiones al SAT: entre reintentos se espera de
+#~ forma exponencial con variación aleatoria, de BACKOFF_BASE hasta
+#~ BACKOFF_MAX segundos. El tiempo de espera de cada URL se ajusta con la
+#~ latencia observada entre TIMEOUT_MIN y TIMEOUT. Con CIRCUIT_FAILURES
+#~ fallas seguidas se suspenden las peticiones CIRCUIT_RESET segundos
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+TIMEOUT_MIN = 10
+CIRCUIT_FAILURES = 10
+CIRCUIT_RESET = 60
+
+#~ Límite adaptable de peticiones simultáneas al SAT: empieza en
+#~ CONCURRENCY_INITIAL y sube de uno en uno mientras las respuestas son
+#~ normales, se reduce a la mitad (hasta CONCURRENCY_MIN) con tiempos
+#~ agotados o errores del servidor. El máximo es DOWNLOAD_WORKERS, o
+#~ ASYNC_LIMIT con -as
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+
+#~ Cantidad máxima de descargas simultáneas por sesión en el SAT, los hilos
+#~ se reutilizan durante toda la ejecución sin importar el total de documentos
+DOWNLOAD_WORKERS = 16
+
+#~ Descargas simultáneas en el modo asíncrono (requiere aiohttp), argumento -as
+ASYNC_LIMIT = 100
+
+#~ Máximo de RFCs que se sincronizan en paralelo con -e o -j, uno por proceso.
+#~ Requiere TOKEN en conf.py, sin él se sincronizan uno por uno para poder
+#~ capturar el captcha
+SYNC_PROCESSES = 4
+
+#~ Modo incremental, argumento -i: se omiten los periodos cuyo total se ha
+#~ confirmado al menos VERIFY_SEARCH veces, que ya están descargados y que
+#~ terminaron hace más de RECENT_DAYS días
+VERIFY_SEARCH = 3
+RECENT_DAYS = 15
+
+#~ Guarda las cookies de la sesión en el SAT por RFC para no identificarse
+#~ (captcha) en cada ejecución. La sesión se valida antes de usarla y se
+#~ descarta después de SESSION_TTL segundos
+SESSION_CACHE = True
+SESSION_PATH = os.path.join(PATH_PROYECT, 'sesiones')
+SESSION_TTL = 7200
+
+#~ Si falla la primera identificación, cuántas sesiones se intentan en
+#~ paralelo. Solo con FIEL o captcha automático (TOKEN en conf.py)
+LOGIN_CANDIDATES = 3
+
+#~ Acuses de cancelación (PDF) que se leen en paralelo para obtener la fecha
+#~ de cancelación. Si está instalado pypdf se leen sin llamar a pdftotext
+PDF_WORKERS = os.cpu_count() or 4
+
+#~ Dónde se guardan los XML descargados, argumento -x: 'disco' (un archivo
+#~ por documento), 'bd' (comprimidos en la base de datos, sin archivos) o
+#~ 'ambos'. Los acuses de cancelación siempre se guardan en disco
+XML_STORAGE = 'disco'
+#~ Compresión de los XML en la base de datos: 'zlib' o 'zstd' (requiere
+#~ zstandard, si no está instalado se usa zlib)
+XML_CODEC = 'zlib'
+
+#~ XML que se envían a la vez a los procesos al extraer sus datos, argumento -ex
+EXTRACT_BATCH = 1000
+
+#~ Consulta del estado de CFDI en el SAT, argumento -ve: URL del servicio
+#~ (se puede cambiar por uno local para pruebas), consultas simultáneas y
+#~ segundos que se conserva en la base de datos el estado consultado
+URL_STATUS = 'https://consultaqr.facturaelectronica.sat.gob.mx/' \
+    'consultacfdiservice.svc'
+STATUS_WORKERS = 8
+STATUS_TTL = 86400
+
 #~ Ruta al ejecutable pdftotext, necesario para extraer la fecha de cancelación
 #~ de los documentos emitidos
 PDF_TO_TEXT = 'pdftotext'
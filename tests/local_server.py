@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+#~ Servidor HTTP local que sustituye al SAT en las pruebas
+
+import http.server
+import threading
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #~ Se asigna en cada prueba: respond(handler, method) -> (estado,
+    #~ encabezados, cuerpo, bytes a enviar o None para todo)
+    respond = None
+
+    def _reply(self, method):
+        status, headers, body, send = self.respond(self, method)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send is None:
+            self.wfile.write(body)
+            return
+        #~ Respuesta cortada para probar reintentos
+        self.wfile.write(body[:send])
+        self.wfile.flush()
+        self.close_connection = True
+        return
+
+    def do_GET(self):
+        self._reply('GET')
+
+    def do_POST(self):
+        self._reply('POST')
+
+    def log_message(self, *args):
+        return
+
+
+def start(respond):
+    """Inicia el servidor en un hilo, regresa (servidor, url base)"""
+    handler = type('LocalHandler', (Handler,),
+        {'respond': staticmethod(respond)})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_port)
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    return
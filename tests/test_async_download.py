@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+import requests
+
+import local_server
+from sat import async_download, policy
+from sat.policy import AdaptiveLimiter, HttpPolicy
+
+
+XML = b'<?xml version="1.0"?><r>' + b'<c a="1"/>' * 20000 + b'</r>'
+
+
+@unittest.skipUnless(async_download.is_available(), 'Requiere aiohttp')
+class TestAsyncDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.hits = collections.Counter()
+        self.cookies = []
+        self.lock = threading.Lock()
+        self.server, self.url = local_server.start(self._respond)
+        self.folder = tempfile.TemporaryDirectory()
+        self.session = requests.Session()
+        self._backoff = policy.backoff
+        policy.backoff = lambda attempt, **kwargs: 0
+        self.downloader = async_download.AsyncDownloader(self.session,
+            policy=HttpPolicy(limiter=AdaptiveLimiter(maximum=8)))
+
+    def tearDown(self):
+        self.downloader.close()
+        policy.backoff = self._backoff
+        local_server.stop(self.server)
+        self.folder.cleanup()
+
+    def _respond(self, handler, method):
+        path = handler.path
+        with self.lock:
+            self.hits[path] += 1
+            hits = self.hits[path]
+            self.cookies.append(handler.headers.get('Cookie', ''))
+
+        if 'busy' in path and hits == 1:
+            return 503, {}, b'', None
+        if 'fail' in path:
+            return 404, {}, b'', None
+
+        headers = {}
+        body = XML
+        status = 200
+        value = handler.headers.get('Range')
+        if value:
+            start = int(value.split('=')[1].rstrip('-'))
+            body = XML[start:]
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, len(XML) - 1, len(XML))
+        if 'cut' in path and hits == 1:
+            return status, headers, body, len(body) // 2
+        return status, headers, body, None
+
+    def _job(self, name, keep=False, acuse=''):
+        return {
+            'url': self.url + name,
+            'path_xml': os.path.join(self.folder.name, name + '.xml'),
+            'keep': keep,
+            'acuse': acuse and self.url + acuse,
+            'path_pdf': os.path.join(self.folder.name, name + '.pdf'),
+        }
+
+    def test_download(self):
+        jobs = [('u{}'.format(i), self._job('ok{}'.format(i))) for i in range(5)]
+        results = self.downloader.download(jobs)
+        self.assertEqual(len(results), 5)
+        size, sha256, data, acuse = results['u0']
+        self.assertEqual(size, len(XML))
+        self.assertEqual(sha256, hashlib.sha256(XML).hexdigest())
+        self.assertIsNone(data)
+        self.assertTrue(acuse)
+        with open(jobs[0][1]['path_xml'], 'rb') as f:
+            self.assertEqual(f.read(), XML)
+
+    def test_resume(self):
+        job = self._job('cut', True)
+        results = self.downloader.download([('u', job)])
+        self.assertEqual(results['u'][2], XML)
+        self.assertEqual(self.hits['/cut'], 2)
+        self.assertFalse(os.path.exists(job['path_xml'] + '.part'))
+
+    def test_retry_status(self):
+        results = self.downloader.download([('u', self._job('busy'))])
+        self.assertIn('u', results)
+        self.assertEqual(self.hits['/busy'], 2)
+
+    def test_acuse(self):
+        jobs = [
+            ('ok', self._job('x1', acuse='a1')),
+            ('xml', self._job('fail1', acuse='a2')),
+            ('acuse', self._job('x2', acuse='fail2')),
+        ]
+        results = self.downloader.download(jobs)
+        self.assertTrue(results['ok'][3])
+        self.assertTrue(os.path.exists(jobs[0][1]['path_pdf']))
+        #~ Sin XML no se pide el acuse
+        self.assertNotIn('xml', results)
+        self.assertEqual(self.hits['/a2'], 0)
+        self.assertEqual(results['acuse'][0], len(XML))
+        self.assertFalse(results['acuse'][3])
+
+        #~ Sin url solo se vuelve a pedir el acuse
+        job = self._job('x2', acuse='a3')
+        job['url'] = ''
+        results = self.downloader.download([('acuse', job)])
+        self.assertEqual(results['acuse'], (None, None, None, True))
+        self.assertEqual(self.hits['/x2'], 1)
+        self.assertEqual(self.hits['/a3'], 1)
+
+    def test_cookies_each_download(self):
+        self.session.cookies.set('sesion', 'uno', domain='127.0.0.1', path='/')
+        self.downloader.download([('u1', self._job('c1'))])
+        self.session.cookies.set('sesion', 'dos', domain='127.0.0.1', path='/')
+        self.downloader.download([('u2', self._job('c2'))])
+        self.assertIn('sesion=uno', self.cookies[0])
+        self.assertIn('sesion=dos', self.cookies[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import calendar
+import unittest
+import uuid
+from datetime import datetime
+
+from sat import db
+from sat.portal_sat import Filters, PortalSAT
+from test_db import DatabaseTestCase, invoice
+
+
+RFC = 'XAXX010101000'
+BEFORE = datetime(2019, 1, 1)
+LIMIT = 500
+
+
+def month(m):
+    last = calendar.monthrange(2018, m)[1]
+    return datetime(2018, m, 1), datetime(2018, m, last, 23, 59, 59)
+
+
+class TestCoverage(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        db.connect()
+
+    def add(self, m, count, downloaded, without_url=0):
+        """Guarda la búsqueda del mes m con count documentos recibidos"""
+        start, end = month(m)
+        invoices = []
+        for i in range(count):
+            u, values = invoice(str(uuid.uuid4()))
+            values['rfc_receptor'] = RFC
+            values['date_cfdi'] = start.replace(day=i % 28 + 1)
+            if i < without_url:
+                values['url'] = ''
+            invoices.append((u, values))
+        for_download = db.previous_download(invoices)
+        db.update_date_download([u for u, v in for_download[:downloaded]])
+        downloads = count - without_url
+        db.save_search(RFC, True, start, end, count, downloads)
+        db.save_search(RFC, True, start, end, count, downloads)
+        return
+
+    def coverage(self, verify=2):
+        return db.get_coverage(RFC, True, verify, BEFORE, LIMIT)
+
+    def test_downloaded(self):
+        self.add(1, 3, 3)
+        self.assertEqual(self.coverage(), (month(1),))
+        self.assertEqual(self.coverage(3), ())
+
+    def test_pending(self):
+        self.add(1, 3, 2)
+        self.assertEqual(self.coverage(), ())
+
+    def test_without_url(self):
+        #~ Los que no tienen liga nunca se descargan, no cuentan
+        self.add(1, 3, 2, 1)
+        self.assertEqual(self.coverage(), (month(1),))
+
+    def test_empty(self):
+        self.add(1, 0, 0)
+        self.assertEqual(self.coverage(), (month(1),))
+
+    def test_old_search(self):
+        #~ Sin downloads se compara contra el total, como antes
+        self.add(1, 3, 3)
+        db.Search.update(downloads=None).execute()
+        self.assertEqual(self.coverage(), (month(1),))
+        self.add(2, 3, 2, 1)
+        db.Search.update(downloads=None).execute()
+        self.assertEqual(self.coverage(), (month(1),))
+
+    def test_limit_and_recent(self):
+        start, end = month(1)
+        db.save_search(RFC, True, start, end, LIMIT, LIMIT)
+        db.save_search(RFC, True, start, end, LIMIT, LIMIT)
+        start, end = datetime(2019, 1, 1), datetime(2019, 1, 31, 23, 59, 59)
+        db.save_search(RFC, True, start, end, 0)
+        db.save_search(RFC, True, start, end, 0)
+        self.assertEqual(self.coverage(), ())
+
+    def test_contiguous(self):
+        self.add(1, 1, 1)
+        self.add(2, 0, 0)
+        self.add(4, 0, 0)
+        self.assertEqual(self.coverage(),
+            ((month(1)[0], month(2)[1]), month(4)))
+
+    def test_skip_verified(self):
+        self.add(1, 2, 2)
+        self.add(2, 0, 0)
+        self.add(3, 2, 1)
+        sat = PortalSAT(RFC, '', False)
+        sat.incremental = True
+        sat.verify = 2
+        sat._load_coverage()
+
+        def filters(m, **kwargs):
+            start, end = month(m)
+            args = {'date_from': start, 'date_to': end, 'emitidas': False}
+            args.update(kwargs)
+            return Filters(args)
+
+        days = [Filters({'date_from': datetime(2018, 2, d), 'day': True,
+            'emitidas': False}) for d in (1, 28)]
+        pending = [filters(3), filters(1, emitidas=True),
+            filters(1, rfc_emisor='AAA010101AAA')]
+        result = sat._skip_verified([filters(1), filters(2)] + days + pending)
+        self.assertEqual(result, pending)
+
+        sat.incremental = False
+        self.assertEqual(len(sat._skip_verified([filters(1)])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+
+from sat import db
+
+
+#~ Esquema de las bases creadas antes de Document, InvoiceDetail, etc.
+BASELINE = (
+    'CREATE TABLE "company" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"rfc" VARCHAR(13) NOT NULL, "name" VARCHAR(250) NOT NULL, '
+    '"ciec" VARCHAR(50) NOT NULL, "folder" TEXT NOT NULL)',
+    'CREATE UNIQUE INDEX "company_rfc" ON "company" ("rfc")',
+    'CREATE TABLE "search" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"rfc" VARCHAR(15) NOT NULL, "recibidas" INTEGER NOT NULL, '
+    '"date_start" DATETIME NOT NULL, "date_end" DATETIME NOT NULL, '
+    '"count" INTEGER NOT NULL, "verify" INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX "search_rfc_recibidas_date_start_date_end" ON '
+    '"search" ("rfc", "recibidas", "date_start", "date_end")',
+    'CREATE TABLE "invoice" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"uuid" TEXT NOT NULL, "xml" TEXT, "path" VARCHAR(2000), '
+    '"date_download" DATETIME, "date_cfdi" DATETIME, "date_timbre" DATETIME, '
+    '"date_cancel" DATETIME, "emisor" VARCHAR(255), "receptor" VARCHAR(255), '
+    '"rfc_emisor" VARCHAR(15), "rfc_receptor" VARCHAR(15), '
+    '"rfc_pac" VARCHAR(15), "tipo" VARCHAR(10), "estatus" VARCHAR(10), '
+    '"total" DECIMAL(10, 4), "acuse" INTEGER NOT NULL, '
+    '"pagada" INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX "invoice_uuid" ON "invoice" ("uuid")',
+    'CREATE TABLE "template" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(190) NOT NULL, "fields" VARCHAR(500) NOT NULL)',
+    'CREATE UNIQUE INDEX "template_name" ON "template" ("name")',
+)
+UUID1 = '0b8d3a36-5e2b-4b8f-9d65-5a3c2bb6b9a1'
+UUID2 = '7f1c2d9e-3a4b-4c5d-8e6f-0a1b2c3d4e5f'
+
+
+def invoice(uuid, url='https://portal/descarga'):
+    return uuid, {
+        'url': url,
+        'acuse': '',
+        'estatus': 'Vigente',
+        'date_cfdi': datetime(2018, 1, 1, 10),
+        'date_timbre': datetime(2018, 1, 1, 10),
+        'date_cancel': None,
+        'rfc_pac': 'SAT970701NN3',
+        'total': 116.0,
+        'tipo': 'Ingreso',
+        'emisor': 'Emisor',
+        'rfc_emisor': 'AAA010101AAA',
+        'receptor': 'Receptor',
+        'rfc_receptor': 'XAXX010101000',
+    }
+
+
+@unittest.skipUnless(db.DB['TYPE'] == 'sqlite', 'Requiere SQLite')
+class DatabaseTestCase(unittest.TestCase):
+    """Cada prueba usa su propia base de datos SQLite"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'invoices.sqlite')
+        self._name = db.database.database
+        self._migrated = db._migrated
+        self.prepare(self.path)
+        db.database.init(self.path)
+        db._migrated = False
+        db._search_index = None
+
+    def tearDown(self):
+        db.database.close()
+        db.database.init(self._name)
+        db._migrated = self._migrated
+        db._search_index = None
+        self.folder.cleanup()
+
+    def prepare(self, path):
+        return
+
+
+class TestBaselineSchema(DatabaseTestCase):
+
+    def prepare(self, path):
+        con = sqlite3.connect(path)
+        for sql in BASELINE:
+            con.execute(sql)
+        con.commit()
+        con.close()
+
+    def test_previous_download(self):
+        db.connect()
+        columns = {c.name for c in db.database.get_columns('invoice')}
+        self.assertIn('check_count', columns)
+        self.assertIn('acuse_mtime', columns)
+        self.assertIn('document', db.database.get_tables())
+
+        result = db.previous_download([invoice(UUID1), invoice(UUID2, '')])
+        self.assertEqual([u for u, v in result], [UUID1])
+        self.assertEqual(db.Invoice.select().count(), 2)
+        row = db.Invoice.get(db.Invoice.uuid == UUID1)
+        self.assertEqual(row.check_count, 0)
+
+    def test_migrate_again(self):
+        db.connect()
+        db.migrate_tables()
+        db.previous_download([invoice(UUID1)])
+        self.assertEqual(db.Invoice.select().count(), 1)
+
+
+class TestDocuments(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        db.connect()
+        db.previous_download([invoice(UUID1), invoice(UUID2)])
+
+    def test_save_xml_concurrent(self):
+        data = b'<cfdi/>'
+        sha256 = hashlib.sha256(data).hexdigest()
+        compress = db._compress
+
+        def other_thread(data):
+            #~ El otro hilo guarda el mismo contenido antes del insert
+            codec, compressed = compress(data)
+            db.Document.create(sha256=sha256, codec=codec, size=len(data),
+                data=compressed)
+            return codec, compressed
+
+        db._compress = other_thread
+        try:
+            db.save_xml([(UUID1, sha256, data)])
+        finally:
+            db._compress = compress
+        db.save_xml([(UUID2, sha256, data)])
+        self.assertEqual(db.Document.select().count(), 1)
+        self.assertEqual(db.get_xml(UUID1), data)
+        self.assertEqual(db.get_xml(UUID2), data)
+
+    def test_zstd_missing(self):
+        zstandard = db.zstandard
+        db.zstandard = None
+        try:
+            with self.assertRaisesRegex(RuntimeError, 'zstandard'):
+                db._decompress('zstd', b'datos')
+        finally:
+            db.zstandard = zstandard
+
+
+class TestStatusInvoices(DatabaseTestCase):
+
+    def test_pages(self):
+        db.connect()
+        expected = []
+        for i in range(5):
+            uuid = '00000000-0000-0000-0000-{:012d}'.format(i)
+            emisor = ('AAA010101AAA', 'BBB010101BBB')[i % 2]
+            db.InvoiceDetail.create(uuid=uuid, rfc_emisor=emisor,
+                rfc_receptor='XAXX010101000', total=i, source=db.SOURCE_DB,
+                sha256='')
+            if not i % 2:
+                expected.append(uuid)
+        rows = list(db.iter_status_invoices('AAA010101AAA', page_size=2))
+        self.assertEqual([str(r[3]) for r in rows], expected)
+        self.assertEqual(len(list(db.iter_status_invoices(page_size=5))), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+#~ Compara Invoice con el parser original basado en HTMLParser, que se
+#~ conserva aquí como referencia. Para ver el rendimiento:
+#~ CFDI_BENCHMARK=1 python -m pytest -s tests/test_invoice_parser.py
+
+import datetime
+import os
+import random
+import time
+import unittest
+from html.parser import HTMLParser
+from uuid import UUID
+
+from sat.portal_sat import Invoice
+
+
+ROWS = 500
+RUNS = 10
+HEADER = '1|#||4|1234|updatePanel|ctl00_MainContent_UpnlResultados|\n' \
+    '<div id="ctl00_MainContent_PnlLimiteRegistros" style="display:{}">' \
+    'limite</div>\n' \
+    '<div id="ctl00_MainContent_PnlNoResultados" style="display:{}">' \
+    'nada</div>\n' \
+    '<div id="ContenedorDinamico"><table class="table">\n' \
+    '<tr><th>Acciones</th><th>Folio Fiscal</th></tr>'
+FOOTER = '</table></div>\n<div id="ctl00_MainContent_pageNavPosition">' \
+    '</div>\n<table><tr><td><span>fuera de la tabla</span></td></tr></table>'
+ROW = """<tr>
+<td class="ListaFolios" style="WIDTH: 60px"><div style="text-align:center">{links}</div></td>
+<td style="WIDTH: 200px"><span style="font-weight:bold">{uuid}</span></td>
+<td><span>{rfc_emisor}</span></td>
+<td><span>{emisor}</span></td>
+<td><span>{rfc_receptor}</span></td>
+<td><span>{receptor}</span></td>
+<td><span>{date}</span></td>
+<td><span>{date}</span></td>
+<td><span>SAT970701NN3</span></td>
+<td><span>{total}</span></td>
+<td><span>{tipo}</span></td>
+<td><span>{estatus}</span></td>
+<td><span>{cancel}</span></td>
+</tr>
+"""
+XML = '<img src="img/ico_xml.png" class="BtnDescarga" name="BtnDescarga" ' \
+    'onclick="return AccionCfdi(\'RecuperaCfdi.aspx?Datos=abc{}&amp;x=1\',' \
+    '\'Recuperacion\');" style="cursor:pointer" />' \
+    '<img class="BtnVerDetalle" name="BtnVerDetalle" onclick="x" />'
+ACUSE = '<img class="BtnRecuperaAcuse" ' \
+    'onclick="AccionCfdi(\'RecuperaAcuse.aspx?Datos=zz{}\',\'Acuse\');" />'
+
+
+def make_page(rows=ROWS, limit=False, seed=1):
+    """Página de resultados sintética con variaciones en cada fila"""
+    rnd = random.Random(seed)
+    start = datetime.datetime(2018, 3, 1)
+    parts = [HEADER.format(
+        'inline' if limit else 'none', 'none')]
+    for i in range(rows):
+        cancelled = i % 7 == 0
+        links = XML.format(i)
+        if cancelled:
+            links += ACUSE.format(i)
+        if i % 11 == 0:
+            #~ Sin liga de descarga
+            links = ''
+        date = start + datetime.timedelta(hours=i, seconds=i * 7)
+        parts.append(ROW.format(
+            links=links,
+            uuid=str(UUID(int=rnd.getrandbits(128))).upper(),
+            rfc_emisor='AAA010101AA{}'.format(i % 10),
+            emisor='EMPRESA &amp; ASOCIADOS {} SA DE CV'.format(i),
+            rfc_receptor='BBB010101BB1',
+            receptor='' if i % 13 == 0 else 'RECEPTOR NUMERO {}'.format(i),
+            date=date.isoformat(),
+            total='${:,.2f}'.format(rnd.uniform(1, 100000)),
+            tipo=('Ingreso', 'Egreso', 'Nómina', 'Pago')[i % 4],
+            estatus='Cancelado' if cancelled else 'Vigente',
+            cancel=(date + datetime.timedelta(days=30)).isoformat()
+                if cancelled else '',
+        ))
+    parts.append(FOOTER)
+    return ''.join(parts)
+
+
+class ReferenceInvoice(HTMLParser):
+    START_PAGE = 'ContenedorDinamico'
+    URL = 'https://portalcfdi.facturaelectronica.sat.gob.mx/'
+    END_PAGE = 'ctl00_MainContent_pageNavPosition'
+    LIMIT_RECORDS = 'ctl00_MainContent_PnlLimiteRegistros'
+    NOT_RECORDS = 'ctl00_MainContent_PnlNoResultados'
+    TEMPLATE_DATE = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self):
+        super().__init__()
+        self._is_div_page = False
+        self._col = 0
+        self._current_tag = ''
+        self._last_link = ''
+        self._last_link_pdf = ''
+        self._last_uuid = ''
+        self._last_status = ''
+        self._last_date_cfdi = ''
+        self._last_date_timbre = ''
+        self._last_pac = ''
+        self._last_total = ''
+        self._last_type = ''
+        self._last_date_cancel = ''
+        self._last_emisor_rfc = ''
+        self._last_emisor = ''
+        self._last_receptor_rfc = ''
+        self._last_receptor = ''
+        self.invoices = []
+        self.not_found = False
+        self.limit = False
+
+    def handle_starttag(self, tag, attrs):
+        self._current_tag = tag
+        if tag == 'div':
+            attrib = dict(attrs)
+            if 'id' in attrib and attrib['id'] == self.NOT_RECORDS \
+                and 'inline' in attrib['style']:
+                self.not_found = True
+            elif 'id' in attrib and attrib['id'] == self.LIMIT_RECORDS:
+                self.limit = True
+            elif 'id' in attrib and attrib['id'] == self.START_PAGE:
+                self._is_div_page = True
+            elif 'id' in attrib and attrib['id'] == self.END_PAGE:
+                self._is_div_page = False
+        elif self._is_div_page and tag == 'td':
+            self._col +=1
+        elif tag == 'img':
+            attrib = dict(attrs)
+            if 'class' in attrib and attrib['class'] == 'BtnDescarga' and \
+                'name' in attrib and attrib['name'] == 'BtnDescarga':
+                self._last_link = attrib['onclick'].split("'")[1]
+            elif 'class' in attrib and attrib['class'] == 'BtnRecuperaAcuse':
+                self._last_link_pdf = attrib['onclick'].split("'")[1]
+
+    def handle_endtag(self, tag):
+        if self._is_div_page and tag == 'tr':
+            if self._last_uuid:
+                url_xml = ''
+                if self._last_link:
+                    url_xml = '{}{}'.format(self.URL, self._last_link)
+                url_pdf = ''
+                if self._last_link_pdf:
+                    url_pdf = '{}{}'.format(self.URL, self._last_link_pdf)
+
+                date_cancel = None
+                if self._last_date_cancel:
+                    date_cancel = datetime.datetime.strptime(
+                        self._last_date_cancel, self.TEMPLATE_DATE)
+                invoice = (self._last_uuid,
+                    {
+                        'url': url_xml,
+                        'acuse': url_pdf,
+                        'estatus': self._last_status,
+                        'date_cfdi': datetime.datetime.strptime(
+                            self._last_date_cfdi, self.TEMPLATE_DATE),
+                        'date_timbre': datetime.datetime.strptime(
+                            self._last_date_timbre, self.TEMPLATE_DATE),
+                        'date_cancel': date_cancel,
+                        'rfc_pac': self._last_pac,
+                        'total': float(self._last_total),
+                        'tipo': self._last_type,
+                        'emisor': self._last_emisor,
+                        'rfc_emisor': self._last_emisor_rfc,
+                        'receptor': self._last_receptor,
+                        'rfc_receptor': self._last_receptor_rfc,
+                    }
+                )
+                self.invoices.append(invoice)
+            self._last_link = ''
+            self._last_link_pdf = ''
+            self._last_uuid = ''
+            self._last_status = ''
+            self._last_date_cancel = ''
+            self._last_emisor_rfc = ''
+            self._last_emisor = ''
+            self._last_receptor_rfc = ''
+            self._last_receptor = ''
+            self._last_date_cfdi = ''
+            self._last_date_timbre = ''
+            self._last_pac = ''
+            self._last_total = ''
+            self._last_type = ''
+            self._col = 0
+
+    def handle_data(self, data):
+        if self._is_div_page and self._current_tag == 'span':
+            if self._col == 2:
+                try:
+                    UUID(data)
+                    self._last_uuid = data
+                except ValueError:
+                    pass
+            elif self._col == 3 and data.split():
+                self._last_emisor_rfc = data.strip()
+            elif self._col == 4 and data.split():
+                self._last_emisor = data.strip()
+            elif self._col == 5 and data.split():
+                self._last_receptor_rfc = data.strip()
+            elif self._col == 6 and data.split():
+                self._last_receptor = data.strip()
+            elif self._col == 7 and data.split():
+                self._last_date_cfdi = data.strip()
+            elif self._col == 8 and data.split():
+                self._last_date_timbre = data.strip()
+            elif self._col == 9 and data.split():
+                self._last_pac = data.strip()
+            elif self._col == 10 and data.split():
+                self._last_total = data.strip().replace('$', '').replace(',', '')
+            elif self._col == 11 and data.split():
+                self._last_type = data.strip().lower()
+            elif self._col == 12 and data.split():
+                self._last_status = data.strip()
+            elif self._col == 13 and data.split():
+                self._last_date_cancel = data.strip()
+
+
+def _parse(cls, html):
+    parser = cls()
+    parser.feed(html)
+    return parser
+
+
+def rows_per_second(cls, html, runs=RUNS):
+    start = time.perf_counter()
+    for _ in range(runs):
+        parser = _parse(cls, html)
+    seconds = time.perf_counter() - start
+    return runs * len(parser.invoices) / seconds
+
+
+class TestInvoice(unittest.TestCase):
+
+    def assertSame(self, html):
+        expected = _parse(ReferenceInvoice, html)
+        result = _parse(Invoice, html)
+        self.assertEqual(result.invoices, expected.invoices)
+        self.assertEqual(result.not_found, expected.not_found)
+        self.assertEqual(result.limit, expected.limit)
+        return result
+
+    def test_same_rows(self):
+        result = self.assertSame(make_page())
+        self.assertEqual(len(result.invoices), ROWS)
+
+    def test_same_rows_limit(self):
+        result = self.assertSame(make_page(20, limit=True, seed=2))
+        self.assertTrue(result.limit)
+
+    def test_not_found(self):
+        html = '<div id="ctl00_MainContent_PnlNoResultados" ' \
+            'style="display:inline">nada</div>'
+        result = self.assertSame(html)
+        self.assertTrue(result.not_found)
+
+    def test_empty(self):
+        result = self.assertSame('')
+        self.assertEqual(result.invoices, [])
+
+
+@unittest.skipUnless(os.environ.get('CFDI_BENCHMARK'), 'Solo con CFDI_BENCHMARK')
+class BenchmarkInvoice(unittest.TestCase):
+    """Solo informa el rendimiento, el tiempo varía con la carga del equipo"""
+
+    def test_rows_per_second(self):
+        html = make_page()
+        old = rows_per_second(ReferenceInvoice, html)
+        new = rows_per_second(Invoice, html)
+        print('\nFilas por segundo en páginas de {} filas: HTMLParser {:.0f}, '
+            'Invoice {:.0f} ({:.1f}x)'.format(ROWS, old, new, new / old))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+#~ Simula el portal, que regresa a lo más MAX_RECORDS documentos por
+#~ búsqueda en el orden que quiera, para revisar que la división de los
+#~ filtros termina, encuentra todos los documentos y hace menos búsquedas
+#~ que la división fija anterior (día, 19 horas, 6 de 10 minutos, minutos)
+
+import datetime
+import math
+import random
+import unittest
+
+from sat.portal_sat import Filters, PortalSAT
+
+
+DAY = datetime.datetime(2018, 3, 15)
+ONE = datetime.timedelta(seconds=1)
+
+
+def ascending(docs):
+    docs.sort(key=lambda d: d[1])
+
+
+def descending(docs):
+    docs.sort(key=lambda d: d[1], reverse=True)
+
+
+def shuffled(docs):
+    random.Random(len(docs)).shuffle(docs)
+
+
+def grid(docs, limit):
+    """Búsquedas de la división fija anterior para un día"""
+    searches = 0
+    pending = [(DAY, DAY.replace(hour=23, minute=59, second=59), 'day')]
+    while pending:
+        start, end, level = pending.pop()
+        searches += 1
+        if sum(1 for d in docs if start <= d[1] <= end) <= limit:
+            continue
+        if level == 'day':
+            hours = (0,) + tuple(range(4, 22)) + (23,)
+            for h1, h2 in zip(hours, hours[1:]):
+                pending.append((DAY + datetime.timedelta(hours=h1),
+                    DAY + datetime.timedelta(hours=h2), 'hour'))
+        elif level == 'hour':
+            for m in range(0, 60, 10):
+                pending.append((start + datetime.timedelta(minutes=m),
+                    start + datetime.timedelta(minutes=m + 10), 'minute'))
+        elif level == 'minute':
+            for m in range(10):
+                pending.append((start + datetime.timedelta(minutes=m),
+                    start + datetime.timedelta(minutes=m + 1), 'stop'))
+    return searches
+
+
+def uniform(count, seed=1):
+    r = random.Random(seed)
+    return [(i, DAY + datetime.timedelta(seconds=r.randrange(86400)))
+        for i in range(count)]
+
+
+class TestSegmentFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.sat = PortalSAT('AAA010101AAA', '', False)
+        self.limit = self.sat.MAX_RECORDS
+
+    def search(self, docs, order, emitidas=True):
+        """Regresa (búsquedas, documentos encontrados)"""
+        searches = 0
+        found = set()
+        pending = [Filters({'date_from': DAY, 'day': True,
+            'emitidas': emitidas})]
+        while pending:
+            f = pending.pop()
+            searches += 1
+            self.assertLess(searches, 1000, 'La división no termina')
+            result = [d for d in docs if f.date_from <= d[1] <= f.date_to]
+            order(result)
+            page = result[:self.limit]
+            found.update(i for i, date in page)
+            if len(result) > self.limit:
+                invoices = [(str(i), {'date_cfdi': date}) for i, date in page]
+                pending.extend(self.sat._segment_filter(f, invoices))
+        return searches, found
+
+    def assertContiguous(self, segments, date_from, date_to):
+        self.assertEqual(segments[0][0], date_from)
+        self.assertEqual(segments[-1][1], date_to)
+        for (s1, e1), (s2, e2) in zip(segments, segments[1:]):
+            self.assertLessEqual(s1, e1)
+            self.assertEqual(s2, e1 + ONE)
+        return
+
+    def assertFewer(self, docs):
+        #~ Con orden aleatorio un día muy denso puede requerir algunas
+        #~ búsquedas más que la división fija, se compara el total
+        minimum = math.ceil(len(docs) / self.limit)
+        total = 0
+        previous = 0
+        for order in (ascending, descending, shuffled):
+            searches, found = self.search(docs, order)
+            self.assertEqual(len(found), len(docs), order.__name__)
+            self.assertLessEqual(searches, 4 * minimum, order.__name__)
+            total += searches
+            previous += grid(docs, self.limit)
+        self.assertLess(total, previous)
+        return
+
+    def test_orders(self):
+        self.assertFewer(uniform(5000))
+        self.assertFewer(uniform(800))
+
+    def test_burst(self):
+        #~ Casi todo en una hora, el resto del día queda en pocos filtros
+        r = random.Random(2)
+        start = DAY.replace(hour=13)
+        docs = [(i, start + datetime.timedelta(seconds=r.randrange(3600)))
+            for i in range(3000)]
+        docs += [(3000 + i, d) for i, d in uniform(200, 3)]
+        self.assertFewer(docs)
+
+    def test_same_second(self):
+        #~ No se puede dividir menos de un segundo, los filtros de un solo
+        #~ segundo no se vuelven a dividir
+        second = DAY.replace(hour=9)
+        docs = [(i, second) for i in range(self.limit + 100)]
+        others = [(len(docs) + i, d) for i, d in uniform(300, 4)]
+        docs += others
+        for order in (ascending, descending, shuffled):
+            searches, found = self.search(docs, order)
+            self.assertLess(searches, 50, order.__name__)
+            self.assertTrue({i for i, d in others} <= found, order.__name__)
+            self.assertGreaterEqual(len(found), self.limit + len(others))
+
+    def test_split_dates(self):
+        date_to = DAY.replace(hour=23, minute=59, second=59)
+        for dates in ([], [DAY.replace(hour=5)] * 10,
+            [d for i, d in uniform(1200)]):
+            segments = self.sat._split_dates(DAY, date_to, dates)
+            self.assertGreaterEqual(len(segments), 2)
+            self.assertContiguous(segments, DAY, date_to)
+            inside = [sum(1 for d in dates if s <= d <= e)
+                for s, e in segments]
+            self.assertEqual(sum(inside), len(dates))
+            self.assertLessEqual(max(inside), max(self.limit // 2,
+                len(dates) // 2 + 1))
+
+    def test_recibidas_days(self):
+        f = Filters({'date_from': DAY.replace(day=1), 'emitidas': False})
+        days = self.sat._segment_filter(f, [])
+        self.assertEqual(len(days), 31)
+        self.assertTrue(all(d.day for d in days))
+        self.assertContiguous([(d.date_from, d.date_to) for d in days],
+            f.date_from, f.date_to)
+
+
+if __name__ == '__main__':
+    unittest.main()
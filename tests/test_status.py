@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+import random
+import re
+import time
+import unittest
+
+import local_server
+from sat import policy, status
+
+
+RESPONSE = """<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+<s:Body><ConsultaResponse xmlns="http://tempuri.org/">
+<ConsultaResult xmlns:a="http://schemas.datacontract.org/2004/07/Sat.Cfdi.Negocio.ConsultaCfdi.Servicio" xmlns:i="http://www.w3.org/2001/XMLSchema-instance">
+<a:CodigoEstatus>S - Comprobante obtenido satisfactoriamente.</a:CodigoEstatus>
+<a:EsCancelable>Cancelable sin aceptación</a:EsCancelable>
+<a:Estado>{}</a:Estado>
+<a:EstatusCancelacion/>
+</ConsultaResult></ConsultaResponse></s:Body></s:Envelope>"""
+RE_UUID = re.compile(r'id=([0-9a-f-]{36})')
+#~ Último dígito del UUID -> respuesta del servicio local
+ESTADO = {
+    '0': 'Vigente',
+    '1': 'Cancelado',
+    '2': 'No Encontrado',
+}
+
+
+def _uuid(i):
+    return '00000000-0000-0000-0000-{:012d}'.format(i)
+
+
+class TestStatusClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = local_server.start(self._respond)
+        self.requests = []
+        self._backoff = policy.backoff
+        policy.backoff = lambda attempt, **kwargs: 0
+
+    def tearDown(self):
+        policy.backoff = self._backoff
+        local_server.stop(self.server)
+
+    def _respond(self, handler, method):
+        length = int(handler.headers['Content-Length'])
+        body = handler.rfile.read(length).decode('utf-8')
+        self.requests.append((handler.headers.get('SOAPAction'), body))
+        uuid = RE_UUID.search(body).group(1)
+        kind = uuid[-1]
+        #~ Respuestas desordenadas para probar el orden de los resultados
+        time.sleep(random.random() / 100)
+        if kind in ESTADO:
+            data = RESPONSE.format(ESTADO[kind]).encode('utf-8')
+            return 200, {'Content-Type': 'text/xml'}, data, None
+        if kind == '3':
+            return 500, {}, b'error', None
+        if kind == '4':
+            return 200, {}, b'<s:Envelope><sin cerrar', None
+        return 200, {}, b'<Envelope><Body/></Envelope>', None
+
+    def test_parse(self):
+        result = status.parse(RESPONSE.format('Vigente').encode('utf-8'))
+        self.assertEqual(result, {
+            'estado': 'Vigente',
+            'codigo': 'S - Comprobante obtenido satisfactoriamente.',
+            'cancelable': 'Cancelable sin aceptación',
+            'estatus_cancelacion': '',
+        })
+        self.assertIsNone(status.parse(b'<Envelope><Body/></Envelope>'))
+
+    def test_query(self):
+        with status.StatusClient(self.url, 2) as client:
+            result = client.query('A&B010101AAA', 'XAXX010101000', '10.50',
+                _uuid(1))
+        self.assertEqual(result['estado'], 'Cancelado')
+        action, body = self.requests[0]
+        self.assertEqual(action, status.HEADERS['SOAPAction'])
+        self.assertIn('?re=A&amp;B010101AAA&amp;rr=XAXX010101000&amp;'
+            'tt=10.50&amp;id={}'.format(_uuid(1)), body)
+
+    def test_query_many_order(self):
+        invoices = [('AAA010101AAA', 'XAXX010101000', '1.00', _uuid(i))
+            for i in range(0, 300, 10)]
+        invoices += [('AAA010101AAA', 'XAXX010101000', '1.00', _uuid(i))
+            for i in range(1, 300, 10)]
+        with status.StatusClient(self.url, 8) as client:
+            results = list(client.query_many(iter(invoices)))
+        self.assertEqual([u for u, r in results], [i[3] for i in invoices])
+        for uuid, result in results:
+            self.assertEqual(result['estado'], ESTADO[uuid[-1]])
+
+    def test_errors(self):
+        invoices = [('AAA010101AAA', 'XAXX010101000', '1.00', _uuid(i))
+            for i in (2, 3, 4, 5)]
+        with status.StatusClient(self.url, 4) as client:
+            results = dict(client.query_many(invoices))
+        self.assertEqual(results[_uuid(2)]['estado'], 'No Encontrado')
+        #~ Error del servidor (después de reintentar), XML inválido y
+        #~ respuesta sin Estado
+        self.assertIsNone(results[_uuid(3)])
+        self.assertIsNone(results[_uuid(4)])
+        self.assertIsNone(results[_uuid(5)])
+        tries = [b for a, b in self.requests if _uuid(3) in b]
+        self.assertEqual(len(tries), policy.TRY_COUNT)
+
+
+if __name__ == '__main__':
+    unittest.main()